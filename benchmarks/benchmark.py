@@ -0,0 +1,251 @@
+# Benchmark of the demand generation and calibration pipeline on synthetic networks.
+
+# Generates grid and spider nets of increasing size with SUMO's netgenerate and times the stages of the pipeline
+# separately: net loading with sumolib and as compact net, building the trip generator, trip sampling, writing
+# the trips, the merge of random_road_rage.py and building calibrators against a local SQLite stand-in of the
+# sensor database.
+# The results are written as JSON. Given a baseline, which is the result file of an earlier run, the benchmark
+# fails if a stage got slower than the baseline by more than the tolerance.
+
+import argparse
+import datetime
+import json
+import math
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import net_cache  # noqa
+import randomTrips  # noqa
+import random_road_rage  # noqa
+import sensor_sources  # noqa
+from calibrate import Calibrate, Scenario  # noqa
+from random_road_rage import RandomRoadRage  # noqa
+import sumolib  # noqa, importable once randomTrips has extended sys.path
+
+NET_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "nets")
+DEFAULT_SIZES = "1000,10000,50000,200000"
+
+
+class Stages:
+    """
+    times stages and records their peak memory, the fastest of repeated runs is kept
+    """
+
+    def __init__(self, memory=True):
+        self.memory = memory
+        # (net, stage) -> dict with seconds and peak_kib
+        self.results = {}
+
+    def run(self, net, stage, function, *args):
+        if self.memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        result = function(*args)
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] // 1024 if self.memory else None
+        previous = self.results.get((net, stage))
+        if previous is None or seconds < previous["seconds"]:
+            self.results[(net, stage)] = {"net": net, "stage": stage, "seconds": seconds, "peak_kib": peak}
+        print("%-14s %-16s %9.3f s%s" % (net, stage, seconds, "" if peak is None else "  %9d KiB" % peak))
+        return result
+
+
+def make_net(kind, edges, net_dir):
+    """
+    generates a grid or spider net with about the given number of edges, reusing earlier ones
+    :param kind: grid or spider
+    :param edges: number of edges to aim for
+    :param net_dir: directory of the generated nets
+    :return: path to the net file
+    """
+    path = os.path.join(net_dir, "%s_%s.net.xml" % (kind, edges))
+    if os.path.isfile(path):
+        return path
+    os.makedirs(net_dir, exist_ok=True)
+    if kind == "grid":
+        # n x n junctions have 4 n (n - 1) edges
+        number = int(math.ceil((1 + math.sqrt(1 + edges)) / 2))
+        args = ["--grid", "--grid.number", str(number), "--grid.length", "100"]
+    else:
+        # about 4 edges for every arm and circle
+        number = max(3, int(round(math.sqrt(edges / 4))))
+        args = ["--spider", "--spider.arm-number", str(number), "--spider.circle-number", str(number),
+                "--spider.space-radius", "100", "--spider.omit-center"]
+    subprocess.check_call([sumolib.checkBinary("netgenerate")] + args +
+                          ["--no-turnarounds", "--no-warnings", "-o", path], stdout=subprocess.DEVNULL)
+    return path
+
+
+def make_sensor_db(path, sensors, hours, per_hour, seed=42):
+    """
+    writes a SQLite stand-in of the sensor database with an entity table of evenly spread vehicles
+    :return: start of the data
+    """
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    start = datetime.datetime(2019, 11, 4)
+    count = sensors * hours * per_hour
+    seconds = rng.integers(0, hours * 3600, count)
+    connection = sqlite3.connect(path)
+    with connection:
+        connection.execute("CREATE TABLE entity (sensor_id INTEGER, time TEXT, speed REAL)")
+        connection.executemany("INSERT INTO entity VALUES (?, ?, ?)",
+                               ((int(sensor), (start + datetime.timedelta(seconds=int(second))).isoformat(" "),
+                                 float(speed))
+                                for sensor, second, speed in zip(rng.integers(1, sensors + 1, count), seconds,
+                                                                 rng.normal(13, 2, count))))
+        connection.execute("CREATE INDEX entity_sensor_time ON entity (sensor_id, time)")
+    connection.close()
+    return start
+
+
+def bench_net(stages, name, net_file, trips, work_dir):
+    options = randomTrips.get_options(["-n", net_file, "-o", os.path.join(work_dir, "trips.xml"),
+                                       "--fringe-factor", "5", "--vehicle-class", "passenger",
+                                       "-e", "86400", "-p", str(86400 / trips), "--batch-size", "10000"])
+    net = stages.run(name, "net_load", sumolib.net.readNet, net_file)
+    stages.run(name, "net_load_compact", net_cache.read_net, net_file)
+    generator = stages.run(name, "build_generator", randomTrips.buildTripGenerator, net, options)
+
+    def sample():
+        rng = randomTrips.np.random.default_rng(1)
+        return [(departs,) + generator.get_trips(rng, len(departs))
+                for departs in randomTrips.get_departs(options, rng)]
+
+    batches = stages.run(name, "sampling", sample)
+
+    def write():
+        with open(options.tripfile, "w") as file:
+            writer = randomTrips.TripWriter(file, net.getEdges(), options, "", "")
+            idx = 0
+            for batch in batches:
+                idx = writer.write(idx, *batch)
+
+    stages.run(name, "writing", write)
+
+    # random_road_rage.py in-process on the loaded net, the merge of the unit outputs is timed on its own
+    rrr = RandomRoadRage(net_file, output_path=work_dir, amount=trips, vehicle_types={"car": 0.8, "truck": 0.2},
+                         seed=1)
+    units = [unit._replace(tmp_file=os.path.join(work_dir, "%s_%s.xml" % (unit.vehicle, unit.idx)))
+             for unit in rrr.work_units()]
+    random_road_rage._worker_net = net
+    tmp_files = stages.run(name, "rrr_units", lambda: [random_road_rage._run_unit(unit) for unit in units])
+    stages.run(name, "rrr_merge", rrr.write_trip_files, units, tmp_files)
+
+
+def bench_calibrate(stages, sensors, work_dir):
+    db_path = os.path.join(work_dir, "sensors.sqlite")
+    start = make_sensor_db(db_path, sensors, 24, 100)
+    calibrate = Calibrate(source=sensor_sources.SQLSource(sensor_sources.create_engine("sqlite:///" + db_path)))
+    calibrate.step_size = 900
+    steps = 24 * 3600 // calibrate.step_size
+    edge_ids = ["e%s" % sensor for sensor in range(1, sensors + 1)]
+    edge_pos = {edge: "10" for edge in edge_ids}
+    edge_sensor = {edge: edge[1:] for edge in edge_ids}
+    name = "sqlite_%s" % sensors
+    stages.run(name, "fetch_aggregates", calibrate.fetch_aggregates,
+               set(int(sensor) for sensor in edge_sensor.values()), start, steps)
+    # the whole calibration as calibrate.py runs it, fetching and writing the calibrators chunk by chunk
+    sumocfg = os.path.join(work_dir, "osm.sumocfg")
+    with open(sumocfg, "w") as file:
+        file.write("<configuration>\n</configuration>\n")
+    stages.run(name, "calibrate", calibrate.calibrate_scenarios,
+               [Scenario(sumocfg, work_dir, edge_ids, edge_pos, edge_sensor, steps)])
+
+
+def compare(results, baseline, tolerance, min_seconds) -> list:
+    """
+    :return: list of (net, stage, seconds, baseline seconds) of the stages slower than the baseline allows
+    """
+    base = {(entry["net"], entry["stage"]): entry["seconds"] for entry in baseline["results"]}
+    slower = []
+    for entry in results:
+        key = (entry["net"], entry["stage"])
+        if key in base and entry["seconds"] > base[key] * (1 + tolerance) and \
+                entry["seconds"] - base[key] > min_seconds:
+            slower.append(key + (entry["seconds"], base[key]))
+    return slower
+
+
+def main():
+    my_parser = argparse.ArgumentParser(prog='benchmark',
+                                        description="times the stages of trip generation and calibration on "
+                                                    "synthetic grid and spider nets")
+    my_parser.add_argument('--sizes', action='store', dest='sizes', default=DEFAULT_SIZES,
+                           help='comma separated numbers of edges of the generated nets (Default %s)' % DEFAULT_SIZES)
+    my_parser.add_argument('--kinds', action='store', dest='kinds', default="grid,spider",
+                           help='comma separated kinds of nets, grid and/or spider')
+    my_parser.add_argument('-t', '--trips', action='store', type=int, dest='trips', default=50000,
+                           help='number of trips to generate on every net')
+    my_parser.add_argument('--sensors', action='store', type=int, dest='sensors', default=200,
+                           help='number of sensors in the SQLite stand-in, 0 skips calibration')
+    my_parser.add_argument('-r', '--repeat', action='store', type=int, dest='repeat', default=1,
+                           help='run everything <int> times and keep the fastest time of every stage')
+    my_parser.add_argument('--net-dir', action='store', dest='net_dir', default=NET_DIR,
+                           help='directory for the generated nets, which are reused by later runs')
+    my_parser.add_argument('--no-memory', action='store_false', dest='memory', default=True,
+                           help='do not trace the peak memory, tracing slows down all stages')
+    my_parser.add_argument('-o', '--output', action='store', dest='output', default="benchmark_results.json",
+                           help='JSON file to write the results to')
+    my_parser.add_argument('-b', '--baseline', action='store', dest='baseline', default=None,
+                           help='results of an earlier run to compare with')
+    my_parser.add_argument('--tolerance', action='store', type=float, dest='tolerance', default=0.25,
+                           help='fail if a stage is more than <float> times slower than in the baseline '
+                                '(Default 0.25)')
+    my_parser.add_argument('--min-seconds', action='store', type=float, dest='min_seconds', default=0.05,
+                           help='ignore slowdowns smaller than <float> seconds, which are mostly noise')
+    args = my_parser.parse_args()
+
+    if randomTrips.np is None:
+        print("numpy is needed for the benchmark")
+        sys.exit(1)
+
+    stages = Stages(args.memory)
+    if args.memory:
+        tracemalloc.start()
+    work_dir = tempfile.mkdtemp(prefix="rrr_benchmark_")
+    try:
+        for _ in range(args.repeat):
+            for kind in args.kinds.split(","):
+                for size in args.sizes.split(","):
+                    net_file = make_net(kind, int(size), args.net_dir)
+                    bench_net(stages, "%s_%s" % (kind, size), net_file, args.trips, work_dir)
+            if args.sensors:
+                bench_calibrate(stages, args.sensors, work_dir)
+                os.remove(os.path.join(work_dir, "sensors.sqlite"))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = {"created": datetime.datetime.now().isoformat(timespec="seconds"),
+               "python": platform.python_version(), "machine": platform.machine(),
+               "trips": args.trips, "sensors": args.sensors, "memory_traced": args.memory,
+               "results": list(stages.results.values())}
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=1)
+    print("Results written to", args.output)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if baseline.get("memory_traced") != args.memory or baseline.get("trips") != args.trips:
+            print("Warning: the baseline was run with other settings, times are not comparable")
+        slower = compare(results["results"], baseline, args.tolerance, args.min_seconds)
+        for net, stage, seconds, base in slower:
+            print("%s %s got slower: %.3f s instead of %.3f s" % (net, stage, seconds, base))
+        if slower:
+            sys.exit(1)
+        print("No stage got slower than the baseline allows")
+
+
+if __name__ == "__main__":
+    main()
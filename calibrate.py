@@ -10,76 +10,280 @@ Date: 19.11.2019
 
 import os
 import sys
+import glob
 import argparse
 import configparser
-from sqlalchemy import create_engine
+from collections import namedtuple
 from colorama import Fore
 from lxml import etree as et
 # import xml.etree.ElementTree as et
-import pandas as pd
 import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+import instrumentation
+import sensor_sources
+import trip_meta
+from sensor_cache import SensorCache
+
+# sensors fetched at once, only the aggregates of one chunk of sensors are held in memory
+SENSOR_CHUNK_SIZE = 500
+
+# one simulation to calibrate, the calibrators are written to output_path
+Scenario = namedtuple("Scenario", ["sumocfg", "output_path", "edge_ids", "edge_pos", "edge_sensor", "steps"])
 
 
 class Calibrate:
 
-    def __init__(self, sumocfg=None):
+    def __init__(self, sumocfg=None, source=None):
+        """
+        :param sumocfg: path to the sumocfg file
+        :param source: sensor_sources.SensorSource to use instead of the one selected in config.cfg
+        """
         self.sumocfg = sumocfg
         self.id_pos_conf = False
         self.output_path = None
 
-        # step sizes to generate in seconds
-        self.step_size = 3600
-
         config = configparser.ConfigParser()
         config.read("config.cfg")
 
-        # needed for pandas read_sql
-        db_connection_str = "mysql+pymysql://" + config['mysql']['user'] + ":" + config['mysql']['password'] + "@" + \
-                            config['mysql']['host'] + "/" + config['mysql']['database']
-        self.db_connection = create_engine(db_connection_str)
+        # step sizes to generate in seconds
+        self.step_size = config.getint('calibrate', 'step_size', fallback=3600)
+
+        # sensors fetched and written at once
+        self.sensor_chunk_size = config.getint('calibrate', 'sensor_chunk_size', fallback=SENSOR_CHUNK_SIZE)
+
+        # local cache of the fetched aggregates, None fetches everything from the source
+        self.sensor_cache = None
+
+        # number of sensors fetched concurrently, 1 fetches all sensors in one query
+        self.workers = 1
+
+        self.source = source if source is not None else sensor_sources.from_config(config)
 
     def main(self):
         my_parser = argparse.ArgumentParser(prog='Advanced Urban Calibrator',
                                             description="A program to automatically create calibrators for "
                                                         "SUMO simulations with traffic data from a database")
 
-        my_parser.add_argument('sumocfg', metavar='input path to sumocfg file', type=str,
-                               help='define the net file (mandatory)')
+        my_parser.add_argument('sumocfg', metavar='input path to sumocfg file', type=str, nargs='+',
+                               help='define the sumocfg file (mandatory). Several sumocfg files, or directories '
+                                    'holding one, are calibrated in one run with the sensor data fetched once')
         my_parser.add_argument('-o', '--output-path', action='store', dest='output_path', default=None,
-                               help='define the output path. ')
+                               help='define the output path. Only for a single sumocfg, otherwise the directory '
+                                    'of each sumocfg is used')
         my_parser.add_argument('-c', '--id_pos_conf', action='store', dest='id_pos_conf', default=False,
                                help='The configuration file to quickly define edges with fitting position and sensor_id')
+        my_parser.add_argument('-m', '--match-sensors', action='store', dest='match_sensors', default=None,
+                               help='match sensors to the closest edges and write the result as id_pos_conf file '
+                                    '(the -c path for a single sumocfg, otherwise id_pos_conf.txt in each output '
+                                    'path). Takes a CSV file '
+                                    'with the columns sensor_id and x, y or lon, lat, or "source" for the '
+                                    'location_table of the SQL source')
+        my_parser.add_argument('--match-distance', action='store', type=float, dest='match_distance', default=50,
+                               help='sensors further than <float> meters from every lane are not matched')
+        my_parser.add_argument('--match-vclass', action='store', dest='match_vclass', default="passenger",
+                               help='match sensors only to lanes allowing this vehicle class')
+        my_parser.add_argument('-s', '--step-size', action='store', type=int, dest='step_size', default=None,
+                               help='length of the calibrator flows in seconds, e.g. 300 or 900 for rush hour peaks. '
+                                    '(Default step_size in config.cfg or 3600)')
+        my_parser.add_argument('--sensor-cache', action='store', dest='sensor_cache', default=None,
+                               help='SQLite file caching the fetched sensor data between runs. '
+                                    '(Default sensor_cache.sqlite in the output path)')
+        my_parser.add_argument('--no-sensor-cache', action='store_true', dest='no_sensor_cache', default=False,
+                               help='fetch all sensor data from the source without caching it')
+        my_parser.add_argument('-w', '--workers', action='store', type=int, dest='workers', default=1,
+                               help='fetch the data of <int> sensors concurrently, each over its own connection')
+        my_parser.add_argument('--refresh-cache', action='store_true', dest='refresh_cache', default=False,
+                               help='drop the cached sensor data and fetch everything again')
+        my_parser.add_argument('--instrument', action='store', dest='instrument', default=None,
+                               help='write the time spent in every stage, the query counts and latencies as JSON '
+                                    'report to this file (or set RRR_INSTRUMENT)')
+        my_parser.add_argument('--cprofile', action='store', dest='cprofile', default=None,
+                               help='write a cProfile dump of the run to this file (or set RRR_CPROFILE)')
 
         args = my_parser.parse_args()
-        self.sumocfg = args.sumocfg
         self.output_path = args.output_path
-        self.id_pos_conf = args.id_pos_conf if os.path.isfile(args.id_pos_conf) else False
+        self.set_workers(args.workers)
+        if args.step_size is not None:
+            self.step_size = args.step_size
+        self.id_pos_conf = args.id_pos_conf if args.id_pos_conf and os.path.isfile(args.id_pos_conf) else False
+
+        sumocfgs = []
+        for path in args.sumocfg:
+            # output directories of random_road_rage.py hold one sumocfg
+            if os.path.isdir(path):
+                found = glob.glob(os.path.join(path, "*.sumocfg"))
+                if len(found) != 1:
+                    print(Fore.RED + "ERROR, " + path + " has to hold exactly one sumocfg file. Exiting")
+                    sys.exit(1)
+                path = found[0]
+            if not os.path.isfile(path):
+                print(Fore.RED + "ERROR, path to sumocfg file " + path + " is not valid. Exiting")
+                sys.exit(1)
+            sumocfgs.append(path)
 
-        if not os.path.isfile(self.sumocfg):
-            print(Fore.RED + "ERROR, path to net file is not valid. Exiting")
+        if self.output_path and len(sumocfgs) > 1:
+            print(Fore.RED + "ERROR, an output path can only be set for a single sumocfg. Exiting")
             sys.exit(1)
 
-        # read file
-        # get output path from net file, if not specified
-        self.output_path = os.path.dirname(self.sumocfg) if not self.output_path else args.output_path
-        passenger_trips_path = os.path.join(self.output_path, "osm.passenger.trips.xml")
+        if self.step_size <= 0:
+            print(Fore.RED + "ERROR, step size must be positive. Exiting")
+            sys.exit(1)
 
-        # get maximum depart time from passenger trips, to get the length of the simulation
-        tree = et.parse(passenger_trips_path)
-        root = tree.getroot()
+        instrumentation.run("calibrate", args.instrument, args.cprofile, self.run, args, sumocfgs)
+
+    def set_workers(self, workers):
+        """
+        sets the number of sensors fetched concurrently, at most as many as the source has connections for
+        :param workers: number of concurrent fetches asked for
+        :return:
+        """
+        max_connections = self.source.max_connections
+        if max_connections is not None and workers > max_connections:
+            # more workers would wait for a free connection until the pool times out
+            print("Warning: the sensor data source serves at most %s connections, using %s instead of %s workers. "
+                  "Raise pool_size in config.cfg for more" % (max_connections, max_connections, workers))
+            workers = max_connections
+        self.workers = workers
+
+    def run(self, args, sumocfgs):
+        """
+        calibrates the scenarios of the sumocfgs as told by the command line
+        :param args: parsed command line arguments
+        :param sumocfgs: paths to the sumocfg files
+        :return:
+        """
+        if args.match_sensors and args.match_distance <= 0:
+            print(Fore.RED + "ERROR, match distance must be positive. Exiting")
+            sys.exit(1)
+
+        scenarios = []
+        edges = None
+        for sumocfg in sumocfgs:
+            self.sumocfg = sumocfg
+            # get output path from net file, if not specified
+            output_path = args.output_path or os.path.dirname(self.sumocfg)
+            if len(sumocfgs) > 1:
+                print("Scenario", self.sumocfg)
+
+            id_pos_conf = self.id_pos_conf
+            if args.match_sensors:
+                id_pos_conf = (args.id_pos_conf if len(sumocfgs) == 1 else False) or \
+                    os.path.join(output_path, "id_pos_conf.txt")
+                with instrumentation.stage("sensor_matching"):
+                    self.match_sensors(args.match_sensors, id_pos_conf, args.match_vclass, args.match_distance)
+
+            # get maximum depart time from the trips of all vehicle classes, to get the length of the simulation
+            with instrumentation.stage("simulation_length"):
+                simulation_length = trip_meta.simulation_length(output_path, verbose=True)
+            if simulation_length is None:
+                print(Fore.RED + "ERROR, no trips found in the trip files of " + os.path.abspath(output_path) +
+                      ". Exiting")
+                sys.exit(1)
+            simulation_length = round(simulation_length)
+            print("Length of simulation:", simulation_length)
+
+            # edges typed in are asked for once and used for all scenarios
+            if id_pos_conf or edges is None:
+                edges = self.read_edges(id_pos_conf)
+
+            # TODO: for the moment assume the start is always at 0:00, Data in Database must fit
+
+            # one flow element each step, calculate number of steps
+            sim_steps = round(simulation_length / self.step_size)
+            print(sim_steps, "step(s) of", self.step_size, "seconds simulated")
 
-        departs = []
-        for trip in root.findall('trip'):
-            departs.append(float(trip.get('depart')))
-        simulation_length = round(max(departs))
-        print("Length of simulation:", simulation_length)
+            scenarios.append(Scenario(self.sumocfg, output_path, *edges, sim_steps))
+
+        if not args.no_sensor_cache:
+            cache_path = args.sensor_cache or os.path.join(scenarios[0].output_path, "sensor_cache.sqlite")
+            self.sensor_cache = SensorCache(cache_path, self.source.name)
+            if args.refresh_cache:
+                self.sensor_cache.clear()
+
+        self.calibrate_scenarios(scenarios)
+
+        if self.sensor_cache is not None:
+            self.sensor_cache.close()
+
+    def calibrate_scenarios(self, scenarios):
+        """
+        fetches the sensor data needed by all scenarios and writes the calibrators of every scenario in the order
+        of its edges. The sensors are fetched in chunks of sensor_chunk_size, the calibrators of a chunk are written
+        to all scenarios before the next chunk is fetched, so only the aggregates of one chunk are held in memory.
+        :param scenarios: list of Scenario
+        :return:
+        """
+        with instrumentation.stage("data_start"):
+            db_data_start = self.get_data_start()
+
+        # Every scenario starts at db_data_start, so the longest one covers the steps of all others.
+        steps = max(scenario.steps for scenario in scenarios)
+
+        paths = [os.path.join(scenario.output_path, "calibrator.xml") for scenario in scenarios]
+        with ExitStack() as stack:
+            writers = [self.open_calibrators(stack, path, scenario.edge_ids)
+                       for scenario, path in zip(scenarios, paths)]
+            # next edge to write of every scenario
+            written = [0] * len(scenarios)
+            edges = [list(scenario.edge_pos.items()) for scenario in scenarios]
+            for chunk, ends in self._sensor_chunks(scenarios, edges):
+                # count and mean speed of every sensor and step, aggregated by the sensor data source
+                with instrumentation.stage("fetch"):
+                    aggregates = self.fetch_aggregates(chunk, db_data_start, steps)
+                with instrumentation.stage("write_calibrators"):
+                    for s, (scenario, xf) in enumerate(zip(scenarios, writers)):
+                        for edge, position in edges[s][written[s]:ends[s]]:
+                            self.write_calibrator(xf, edge, position, int(scenario.edge_sensor[edge]), aggregates,
+                                                  scenario.steps)
+                        written[s] = ends[s]
+
+        for scenario, calibrators_path in zip(scenarios, paths):
+            self.sumocfg = scenario.sumocfg
+            self.output_path = scenario.output_path
+            instrumentation.count("bytes_written", os.path.getsize(calibrators_path))
+
+            # add calibrator.xml to osm.sumocfg
+            with instrumentation.stage("sumocfg"):
+                self.add_additional_file(os.path.basename(calibrators_path))
+
+    def _sensor_chunks(self, scenarios, edges):
+        """
+        splits the sensors into chunks of at most sensor_chunk_size, following the edges of every scenario,
+        so the calibrators can be written in the order of the edges whatever the chunk size is.
+        A sensor shared by edges far apart may be fetched in more than one chunk.
+        :param scenarios: list of Scenario
+        :param edges: list of (edge, position) per scenario, in the order the calibrators are written
+        :return: generator of (list of sensor ids, index of the first edge left out of the chunk per scenario)
+        """
+        ends = [0] * len(scenarios)
+        while any(end < len(scenario_edges) for end, scenario_edges in zip(ends, edges)):
+            chunk = {}
+            for s, scenario in enumerate(scenarios):
+                while ends[s] < len(edges[s]):
+                    sensor_id = int(scenario.edge_sensor[edges[s][ends[s]][0]])
+                    if sensor_id not in chunk:
+                        if chunk and len(chunk) >= self.sensor_chunk_size:
+                            break
+                        chunk[sensor_id] = None
+                    ends[s] += 1
+            yield list(chunk), list(ends)
 
+    def read_edges(self, id_pos_conf=False) -> tuple:
+        """
+        reads the edges to calibrate with the position and sensor id of each, from the id_pos_conf file if given,
+        otherwise from the command line
+        :param id_pos_conf: path of the id_pos_conf file or False
+        :return: (list of edge ids, dictionary edge -> position, dictionary edge -> sensor id)
+        """
         edge_pos = {}
         edge_sensor = {}
         edge_ids = []
         # read from config, if specified: Lane_id whitespace position new line
-        if self.id_pos_conf:
-            file = open(self.id_pos_conf, "r")
+        if id_pos_conf:
+            file = open(id_pos_conf, "r")
             contents = file.read()
             contents = contents.split("\n")
             for i in contents:
@@ -124,78 +328,201 @@ class Calibrate:
                                   "If finished Press Enter again to input an empty String: \n")
                 edge_sensor[edge] = int(tmp_input)
 
-        calibrators_path = os.path.join(self.output_path, "calibrator.xml")
-
-        root = et.Element('additional')
-        et.SubElement(root, 'vType', id="t0", speedDev="0.1", speedFactor="1.2", sigma="0")
-        for edge in edge_ids:
-            et.SubElement(root, 'routeProbe', id="probe_" + edge, edge=edge, freq="60", file="routeProbe_output.xml")
+        return edge_ids, edge_pos, edge_sensor
 
-        # TODO: for the moment assume the start is always at 0:00, Data in Database must fit
+    def match_sensors(self, locations, id_pos_conf, v_class="passenger", max_distance=50):
+        """
+        matches the sensors to the closest edges of the net of the sumocfg and writes them as id_pos_conf file
+        :param locations: CSV file with the sensor coordinates, or "source" to take them from the sensor data source
+        :param id_pos_conf: path of the id_pos_conf file to write
+        :param v_class: vehicle class the lanes have to allow
+        :param max_distance: sensors further away from every lane are left out
+        :return:
+        """
+        import sensor_matching
+
+        try:
+            if locations == "source":
+                locations = sensor_matching.check_locations(self.source.sensor_locations(), self.source.name)
+            else:
+                locations = sensor_matching.read_locations(locations)
+        except ValueError as error:
+            print(Fore.RED + "ERROR, " + str(error) + ". Exiting")
+            sys.exit(1)
 
-        # one flow element each hour, calculate number of hours
-        sim_h = round(simulation_length / 3600)
-        print(sim_h, "hour(s) simulated")
+        net_file = et.parse(self.sumocfg).getroot().find("input/net-file")
+        if net_file is None or not net_file.get("value"):
+            print(Fore.RED + "ERROR, " + self.sumocfg + " has no input/net-file to match the sensors on. Exiting")
+            sys.exit(1)
+        net = sensor_matching.sumolib.net.readNet(os.path.join(os.path.dirname(self.sumocfg), net_file.get("value")))
+        matches = sensor_matching.match(net, locations, v_class, max_distance, verbose=True)
+        sensor_matching.write_id_pos_conf(id_pos_conf, matches)
+        print(len(matches), "of", len(locations), "sensors matched to edges, written to", id_pos_conf)
 
-        # TODO: excuse me WTF, don't load everything at once.
-        # read only min date for start values, pandas is not really required, but convenient
-        df = pd.read_sql('SELECT MIN(time) FROM entity', con=self.db_connection)
-        df = df["MIN(time)"][0]
-        # start_hour = df.hour
-        start_date = df.date()
+    def open_calibrators(self, stack, path, edge_ids):
+        """
+        starts a calibrator file with the vType and the route probes, the calibrators follow with write_calibrator
+        :param stack: contextlib.ExitStack closing the file when it exits
+        :param path: path of the calibrator file
+        :param edge_ids: edges to put route probes on
+        :return: lxml xmlfile writing into the root element
+        """
+        file = stack.enter_context(open(path, "wb"))
+        # pretty_print ends the file with a line break, which xmlfile can't write after the root
+        stack.callback(file.write, b"\n")
+        xf = stack.enter_context(et.xmlfile(file))
+        stack.enter_context(xf.element("additional"))
+        stack.callback(xf.write, "\n")
+
+        elements = [et.Element('vType', id="t0", speedDev="0.1", speedFactor="1.2", sigma="0")]
+        for edge in edge_ids:
+            elements.append(et.Element('routeProbe', id="probe_" + edge, edge=edge, freq="60",
+                                       file="routeProbe_output.xml"))
+        for element in elements:
+            self._write_child(xf, element)
+        return xf
 
-        db_data_start = datetime.datetime(start_date.year, start_date.month, start_date.day, 0, 0, 0)
+    def write_calibrator(self, xf, edge, position, sensor_id, aggregates, steps):
+        """
+        writes the calibrator of an edge with a flow for every step the sensor has data for
+        :param xf: lxml xmlfile as returned by open_calibrators
+        :param edge: edge id
+        :param position: position of the calibrator on the edge
+        :param sensor_id: id of the sensor of the edge
+        :param aggregates: dictionary (sensor_id, step index) -> (count, mean speed), holding the sensor
+        :param steps: number of steps to write flows for
+        :return:
+        """
+        et_cali = et.Element("calibrator", id="calibtest_edge", edge=edge, pos=str(position), output="detector.xml")
+        for i in range(steps):
+            # if there is no entry, the database has no data for this step, just skip
+            if (sensor_id, i) not in aggregates:
+                continue
+
+            vehicles, speed = aggregates[(sensor_id, i)]
+            # calibrators take an hourly rate, whatever the step size is
+            veh_per_hour = vehicles * 3600 / self.step_size
+            if veh_per_hour.is_integer():
+                veh_per_hour = int(veh_per_hour)
+
+            et.SubElement(et_cali, "flow", begin=str(i * self.step_size),
+                          end=str((i + 1) * self.step_size), vehsPerHour=str(veh_per_hour),
+                          speed=str(speed), type="t0", departPos="free", departSpeed="max")
+
+        self._write_child(xf, et_cali)
+        xf.flush()
+
+    @staticmethod
+    def _write_child(xf, element):
+        """
+        writes an element into the root of an lxml xmlfile, indented like pretty_print would
+        """
+        et.indent(element, space="  ", level=1)
+        xf.write("\n  ")
+        xf.write(element)
 
-        for edge, position in edge_pos.items():
-            et_cali = et.SubElement(root, "calibrator",
-                                    id="calibtest_edge", edge=edge, pos=position, output="detector.xml")
-            begin = 0
-            end = self.step_size
-
-            sensor_id = edge_sensor[edge]
-            for i in range(sim_h):
-
-                db_fetch_start = db_data_start + self._tick_to_timedelta(begin)
-                db_fetch_end = db_data_start + self._tick_to_timedelta(end)
-                # print(db_fetch_start, db_fetch_end)
-                df = pd.read_sql("SELECT * FROM entity WHERE time BETWEEN \"{}\" AND \"{}\" AND sensor_id = {}"
-                                 .format(db_fetch_start.strftime("%Y-%m-%d %H:%M:%S"),
-                                         db_fetch_end.strftime("%Y-%m-%d %H:%M:%S"), sensor_id), con=self.db_connection)
-
-                # if df is empty database has no data for this hour, just skip
-                if df.empty:
-                    begin = end
-                    end = end + self.step_size
-                    continue
+    def add_additional_file(self, name):
+        """
+        adds an additional file to the sumocfg, if it isn't listed already
+        :param name: file name relative to the sumocfg
+        :return:
+        """
+        # without the blank text, pretty_print indents added elements as well
+        tree = et.parse(self.sumocfg, et.XMLParser(remove_blank_text=True))
+        root = tree.getroot()
 
-                speed = df["speed"].mean()
-                veh_per_hour = len(df.index)
+        input_tag = root.find("input")
+        if input_tag is None:
+            input_tag = et.SubElement(root, "input")
+        additional = input_tag.find("additional-files")
+        if additional is None:
+            et.SubElement(input_tag, "additional-files", value=name)
+        elif name not in additional.get("value", "").split(","):
+            additional.set("value", additional.get("value") + "," + name if additional.get("value") else name)
+        else:
+            return
+        tree.write(self.sumocfg, pretty_print=True)
 
-                et.SubElement(et_cali, "flow", begin=str(begin), end=str(end), vehsPerHour=str(veh_per_hour),
-                              speed=str(speed), type="t0", departPos="free", departSpeed="max")
+    def get_data_start(self) -> datetime.datetime:
+        """
+        start of the day the sensor data begins with, taken from the sensor cache if possible
+        :return datetime.datetime:
+        """
+        if self.sensor_cache is not None and self.sensor_cache.get_data_start() is not None:
+            return self.sensor_cache.get_data_start()
 
-                begin = end
-                end = end + self.step_size
+        start_date = self.source.data_start().date()
 
-        calibrator = et.ElementTree(root)
-        calibrator.write(calibrators_path, pretty_print=True)
+        db_data_start = datetime.datetime(start_date.year, start_date.month, start_date.day, 0, 0, 0)
+        if self.sensor_cache is not None:
+            self.sensor_cache.set_data_start(db_data_start)
+        return db_data_start
 
-        # add calibrator.xml to osm.sumocfg
+    def fetch_aggregates(self, sensor_ids, db_data_start, buckets) -> dict:
+        """
+        counts the entities and averages their speed per sensor and time step.
+        With a sensor cache only the steps after the cached ones are fetched from the source.
+        :param sensor_ids: ids of the sensors to fetch
+        :param db_data_start: datetime of the first simulation step in the database
+        :param buckets: number of time steps of step_size seconds to fetch
+        :return: dictionary (sensor_id, step index) -> (count, mean speed), steps without data are missing
+        """
+        sensor_ids = sorted(set(int(i) for i in sensor_ids))
+        db_data_end = db_data_start + self._tick_to_timedelta(buckets * self.step_size)
+        if self.sensor_cache is None:
+            aggregates = {}
+            for fetch_ids, fetch_start, fetched in self._run_queries({db_data_start: sensor_ids}, db_data_end):
+                aggregates.update(fetched)
+        else:
+            missing = self.sensor_cache.missing(sensor_ids, self.step_size, db_data_start, db_data_end)
+            for fetch_ids, fetch_start, fetched in self._run_queries(missing, db_data_end):
+                self.sensor_cache.store(fetch_ids, self.step_size, fetch_start, db_data_end, fetched)
+            aggregates = self.sensor_cache.load(sensor_ids, self.step_size, db_data_start, db_data_end)
 
-        tree = et.parse(self.sumocfg)
-        root = tree.getroot()
+        return {(sensor_id, int((bucket_start - db_data_start).total_seconds()) // self.step_size): value
+                for (sensor_id, bucket_start), value in aggregates.items()}
 
-        for i, tag in enumerate(root):
-            if tag.tag == "input":
-                for j, tag in enumerate(root[i]):
-                    if tag.tag == "additional-files":
-                        val = root[i][j].get("value")
-                        if "calibrator.xml" in val:
-                            break
-                        else:
-                            root[i][j].set("value", val + ",calibrator.xml")
-        calibrator = et.ElementTree(root)
-        calibrator.write(self.sumocfg, pretty_print=True)
+    def _run_queries(self, fetches, end) -> list:
+        """
+        runs _query_aggregates for all fetches. With more than one worker every sensor is fetched on its own,
+        concurrently over the connection pool.
+        :param fetches: dictionary fetch start datetime -> list of sensor ids
+        :param end: datetime after the last step
+        :return: list of (sensor ids, fetch start, fetched aggregates) in the order of the fetches
+        """
+        tasks = []
+        for start, sensor_ids in sorted(fetches.items()):
+            if self.workers > 1:
+                tasks += [([sensor_id], start) for sensor_id in sorted(sensor_ids)]
+            else:
+                tasks.append((sorted(sensor_ids), start))
+
+        if self.workers <= 1 or len(tasks) <= 1:
+            return [(ids, start, self._query_aggregates(ids, start, end)) for ids, start in tasks]
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = [pool.submit(self._query_aggregates, ids, start, end) for ids, start in tasks]
+            # results in submission order, independent of which query finished first
+            return [(ids, start, future.result()) for (ids, start), future in zip(tasks, futures)]
+
+    def _query_aggregates(self, sensor_ids, start, end) -> dict:
+        """
+        counts the entities and averages their speed per sensor and time step, aggregated by the source
+        :param sensor_ids: ids of the sensors to fetch
+        :param start: datetime of the first step
+        :param end: datetime after the last step
+        :return: dictionary (sensor_id, step start datetime) -> (count, mean speed)
+        """
+        if not instrumentation.enabled():
+            return self.source.aggregate(sensor_ids, start, end, self.step_size)
+        query_start = time.perf_counter()
+        aggregates = self.source.aggregate(sensor_ids, start, end, self.step_size)
+        latency = time.perf_counter() - query_start
+        instrumentation.count("db_queries")
+        instrumentation.count("db_query_seconds", latency)
+        instrumentation.maximum("db_query_seconds_max", latency)
+        instrumentation.count("db_rows", len(aggregates))
+        return aggregates
 
     def _tick_to_timedelta(self, tick, tick_length=1, sim_start_hour=0) -> datetime.timedelta:
         """
@@ -0,0 +1,124 @@
+# Time-varying traffic demand for randomTrips.py and random_road_rage.py.
+
+# A profile describes which share of the total demand departs in which part of the simulated time.
+# Profile files are read line by line, '#' starts a comment. Either every line holds an interval
+#   begin end share
+# with a constant departure rate inside the interval, or every line holds a point of a rate curve
+#   time rate
+# which is interpolated linearly between the points.
+
+import math
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class DemandProfile:
+
+    def __init__(self, intervals, rate_curve=False):
+        """
+        :param intervals: list of [begin, end, share] in seconds, sorted and not overlapping.
+                          The shares don't need to add up to 1, they are relative to each other.
+                          A share of 0 is an interval without departures.
+        :param rate_curve: the intervals are the short steps of a rate curve rather than intervals of their own
+        """
+        self.rate_curve = rate_curve
+        self.intervals = [[float(begin), float(end), float(share)] for begin, end, share in intervals]
+        for (begin, end, share), following in zip(self.intervals, self.intervals[1:] + [None]):
+            if begin >= end or share < 0:
+                raise ValueError("invalid profile interval %s-%s with share %s" % (begin, end, share))
+            if following is not None and following[0] < end:
+                raise ValueError("profile intervals %s-%s and %s-%s overlap" % (begin, end, following[0],
+                                                                                following[1]))
+
+    @classmethod
+    def load(cls, path, resolution=60):
+        """
+        reads a profile file
+        :param path: path to the profile file
+        :param resolution: length in seconds of the constant rate steps a rate curve is split into
+        :return: DemandProfile
+        """
+        rows = []
+        with open(path) as file:
+            for line in file:
+                line = line.split("#", 1)[0].split()
+                if line:
+                    rows.append([float(value) for value in line])
+
+        if rows and all(len(row) == 3 for row in rows):
+            return cls(rows)
+        if rows and all(len(row) == 2 for row in rows):
+            return cls.from_rates(rows, resolution)
+        raise ValueError("%s is no valid profile, every line needs either 'begin end share' or 'time rate'" % path)
+
+    @classmethod
+    def from_rates(cls, points, resolution=60):
+        """
+        turns a rate curve, linear between the given points, into steps of constant rate
+        :param points: list of [time, rate], sorted by time
+        :param resolution: length of the steps in seconds
+        :return: DemandProfile
+        """
+        intervals = []
+        for (time, rate), (next_time, next_rate) in zip(points, points[1:]):
+            steps = max(1, int(math.ceil(round((next_time - time) / resolution, 9))))
+            for i in range(steps):
+                begin = time + (next_time - time) * i / steps
+                end = time + (next_time - time) * (i + 1) / steps
+                # the mean of a linear rate is its value at the middle of the step
+                middle = (i + 0.5) / steps
+                intervals.append([begin, end, (rate + (next_rate - rate) * middle) * (end - begin)])
+        return cls(intervals, rate_curve=True)
+
+    def clip(self, begin, end):
+        """
+        the part of the profile between begin and end, with the shares scaled to add up to 1.
+        Intervals cut by begin or end keep the share of their remaining length.
+        :param begin: begin time in seconds
+        :param end: end time in seconds
+        :return: DemandProfile
+        """
+        clipped = []
+        for i_begin, i_end, share in self.intervals:
+            new_begin, new_end = max(i_begin, begin), min(i_end, end)
+            if new_begin < new_end:
+                clipped.append([new_begin, new_end, share * (new_end - new_begin) / (i_end - i_begin)])
+        total = sum(share for _, _, share in clipped)
+        if total <= 0:
+            raise ValueError("no demand between %s and %s" % (begin, end))
+        return DemandProfile([[i_begin, i_end, share / total] for i_begin, i_end, share in clipped], self.rate_curve)
+
+    def departures(self, count, rng=None, poisson=False, chunk_size=10000):
+        """
+        departure times following the profile, generated chunk by chunk so they are never all held in memory
+        :param count: number of departures, the expected number if poisson is set
+        :param rng: numpy random generator, needed for poisson
+        :param poisson: draw the departures from a non-homogeneous poisson process instead of spacing them evenly
+                        over the cumulative demand
+        :param chunk_size: departures per chunk, every chunk but the last one has exactly this size
+        :return: generator of sorted numpy arrays of departure times, in ascending order
+        """
+        times = []
+        demand = [0.0]
+        for begin, end, share in self.intervals:
+            times += [begin, end]
+            demand += [demand[-1], demand[-1] + share]
+        demand = np.array(demand[1:]) / demand[-1]
+
+        if not poisson:
+            for start in range(0, count, chunk_size):
+                yield np.interp(np.arange(start, min(start + chunk_size, count)) / count, demand, times)
+            return
+        # a poisson process with rate count on the cumulative demand [0, 1), from exponential gaps
+        position = 0.0
+        while count > 0:
+            positions = position + np.cumsum(rng.exponential(1.0 / count, chunk_size))
+            positions = positions[positions < 1]
+            if len(positions):
+                yield np.interp(positions, demand, times)
+            if len(positions) < chunk_size:
+                return
+            position = positions[-1]
@@ -0,0 +1,164 @@
+# Per-stage timing and counters for randomTrips.py, random_road_rage.py and calibrate.py.
+
+# Instrumentation is off by default and costs next to nothing then. It is switched on by the --instrument option
+# of the entry points or the environment variable RRR_INSTRUMENT, both naming the JSON report to write.
+# --cprofile or RRR_CPROFILE additionally write a cProfile dump of the whole run.
+#
+#   with instrumentation.stage("net_load"):
+#       net = sumolib.net.readNet(net_file)
+#   instrumentation.count("trips", len(trips))
+
+import contextlib
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+
+REPORT_ENV = "RRR_INSTRUMENT"
+CPROFILE_ENV = "RRR_CPROFILE"
+
+_enabled = False
+_lock = threading.Lock()
+# stage name -> [calls, wall seconds, cpu seconds]
+_stages = {}
+# counter name -> value
+_counters = {}
+
+
+def enabled():
+    return _enabled
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def reset():
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+
+
+@contextlib.contextmanager
+def _measure(name):
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield
+    finally:
+        add_stage(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+
+def stage(name):
+    """
+    context manager adding the wall and cpu time of its block to the stage, nested stages are counted in both
+    :param name: name of the stage
+    """
+    return _measure(name) if _enabled else contextlib.nullcontext()
+
+
+def add_stage(name, wall, cpu, calls=1):
+    if not _enabled:
+        return
+    with _lock:
+        entry = _stages.setdefault(name, [0, 0.0, 0.0])
+        entry[0] += calls
+        entry[1] += wall
+        entry[2] += cpu
+
+
+def count(name, value=1):
+    """
+    adds value to the counter, safe to call from several threads
+    """
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def maximum(name, value):
+    """
+    keeps the largest value given for the counter
+    """
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = max(_counters.get(name, value), value)
+
+
+def take():
+    """
+    returns the recorded data and starts over, to hand the data of a worker process to the parent
+    :return: (stages, counters)
+    """
+    with _lock:
+        data = ({name: list(entry) for name, entry in _stages.items()}, dict(_counters))
+    reset()
+    return data
+
+
+def merge(data):
+    """
+    adds data returned by take in another process
+    """
+    stages, counters = data
+    for name, (calls, wall, cpu) in stages.items():
+        add_stage(name, wall, cpu, calls)
+    for name, value in counters.items():
+        if name.endswith("_max"):
+            maximum(name, value)
+        else:
+            count(name, value)
+
+
+def report(entry_point, wall, cpu) -> dict:
+    """
+    :param entry_point: name of the program
+    :param wall: wall time of the whole run in seconds
+    :param cpu: cpu time of the whole run in seconds
+    :return: the recorded stages and counters, with rates for the counters of trips and bytes
+    """
+    with _lock:
+        counters = dict(_counters)
+        stages = {name: {"calls": calls, "wall": wall_time, "cpu": cpu_time}
+                  for name, (calls, wall_time, cpu_time) in sorted(_stages.items())}
+    rates = {}
+    for name in ("trips", "bytes_written", "output_bytes"):
+        if counters.get(name) and wall > 0:
+            rates[name + "_per_second"] = counters[name] / wall
+    return {"entry_point": entry_point, "argv": sys.argv, "wall": wall, "cpu": cpu,
+            "stages": stages, "counters": counters, "rates": rates}
+
+
+def run(entry_point, report_path, cprofile_path, function, *args):
+    """
+    runs an entry point, instrumented if a report or profile path is given here or in the environment
+    :param entry_point: name of the program, written to the report
+    :param report_path: JSON report to write, None for RRR_INSTRUMENT
+    :param cprofile_path: cProfile dump to write, None for RRR_CPROFILE
+    :param function: main function of the entry point
+    :return: return value of the function
+    """
+    report_path = report_path or os.environ.get(REPORT_ENV)
+    cprofile_path = cprofile_path or os.environ.get(CPROFILE_ENV)
+    if report_path:
+        enable()
+    profiler = cProfile.Profile() if cprofile_path else None
+
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        if profiler is not None:
+            return profiler.runcall(function, *args)
+        return function(*args)
+    finally:
+        if profiler is not None:
+            profiler.dump_stats(cprofile_path)
+        if report_path:
+            with open(report_path, "w") as file:
+                json.dump(report(entry_point, time.perf_counter() - wall, time.process_time() - cpu), file,
+                          indent=1)
@@ -0,0 +1,337 @@
+# Persistent cache of the parts of a SUMO net that randomTrips.py needs for trip generation.
+
+# Parsing a large .net.xml with sumolib builds lanes, connections and shapes which are never used
+# when drawing random trips. The fields needed for the edge probabilities and the distance checks are
+# read from the net file directly into compact edge records, stored next to a content hash of the net file
+# and loaded from there on later runs.
+
+import hashlib
+import os
+import pickle
+from xml.etree import ElementTree
+
+# bump when the cached fields change, so old cache files are not loaded anymore
+CACHE_VERSION = 1
+
+INCOMING = "_incoming"
+OUTGOING = "_outgoing"
+
+
+class CachedNode:
+    __slots__ = ("_coord",)
+
+    def __init__(self, coord):
+        self._coord = coord
+
+    def getCoord(self):
+        return self._coord
+
+
+class CachedEdge:
+    """
+    stand-in for sumolib.net.edge.Edge, offering the methods randomTrips.py uses
+    """
+    __slots__ = ("_id", "_from", "_to", "_length", "_lanes", "_speed", "_allowed", "_fringe_incoming",
+                 "_fringe_outgoing", "_bbox", "_params")
+
+    # is_fringe is called with these instead of the connection dictionaries of a sumolib edge
+    _incoming = INCOMING
+    _outgoing = OUTGOING
+
+    def __init__(self, id, from_node, to_node, length, lanes, speed, allowed, fringe_incoming, fringe_outgoing,
+                 bbox, params):
+        self._id = id
+        self._from = from_node
+        self._to = to_node
+        self._length = length
+        self._lanes = lanes
+        self._speed = speed
+        self._allowed = allowed
+        self._fringe_incoming = fringe_incoming
+        self._fringe_outgoing = fringe_outgoing
+        self._bbox = bbox
+        self._params = params
+
+    def getID(self):
+        return self._id
+
+    def getFromNode(self):
+        return self._from
+
+    def getToNode(self):
+        return self._to
+
+    def getLength(self):
+        return self._length
+
+    def getLaneNumber(self):
+        return self._lanes
+
+    def getSpeed(self):
+        return self._speed
+
+    def allows(self, vClass):
+        if vClass is None or vClass == "ignoring":
+            return True
+        return vClass in self._allowed
+
+    def is_fringe(self, connections=None):
+        if connections is None:
+            return self._fringe_incoming or self._fringe_outgoing
+        return self._fringe_incoming if connections == INCOMING else self._fringe_outgoing
+
+    def getBoundingBox(self):
+        return self._bbox
+
+    def getParam(self, key, default=None):
+        return self._params.get(key, default)
+
+
+class CachedNet:
+    """
+    stand-in for sumolib.net.Net, holding only the edges and the boundary
+    """
+
+    def __init__(self, edges, boundary, bbox_diameter):
+        self._edges = edges
+        self._boundary = boundary
+        self._bbox_diameter = bbox_diameter
+
+    def getEdges(self):
+        return self._edges
+
+    def getBoundary(self):
+        return list(self._boundary)
+
+    def getBBoxDiameter(self):
+        return self._bbox_diameter
+
+
+def net_digest(net_file, chunk_size=1 << 20) -> str:
+    """
+    content hash of a net file
+    :param net_file: path to the .net.xml (or .net.xml.gz)
+    :param chunk_size: bytes read at once
+    :return: hex digest
+    """
+    digest = hashlib.sha256()
+    with open(net_file, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def extract(net) -> dict:
+    """
+    collects the fields used for trip generation from a sumolib net
+    :param net: sumolib.net.Net
+    :return: dictionary of per edge columns and net wide values
+    """
+    # identical permission sets are shared, most edges of a city net allow the same classes
+    permissions = {}
+    columns = {"id": [], "from_coord": [], "to_coord": [], "length": [], "lanes": [], "speed": [], "allowed": [],
+               "fringe_incoming": [], "fringe_outgoing": [], "bbox": [], "params": []}
+    for edge in net.getEdges():
+        allowed = frozenset(edge.getPermissions())
+        allowed = permissions.setdefault(allowed, allowed)
+        columns["id"].append(edge.getID())
+        columns["from_coord"].append(tuple(edge.getFromNode().getCoord()))
+        columns["to_coord"].append(tuple(edge.getToNode().getCoord()))
+        columns["length"].append(edge.getLength())
+        columns["lanes"].append(edge.getLaneNumber())
+        columns["speed"].append(edge.getSpeed())
+        columns["allowed"].append(allowed)
+        columns["fringe_incoming"].append(edge.is_fringe(edge._incoming))
+        columns["fringe_outgoing"].append(edge.is_fringe(edge._outgoing))
+        columns["bbox"].append(tuple(edge.getBoundingBox()))
+        columns["params"].append(dict(edge.getParams()) if edge.getParams() else None)
+
+    return {"version": CACHE_VERSION, "edges": columns,
+            "boundary": tuple(net.getBoundary()), "bbox_diameter": net.getBBoxDiameter()}
+
+
+def _shape(value):
+    # 2d points of a shape attribute, like sumolib.net.convertShape without z
+    return [tuple(float(c) for c in point.split(",")[:2]) for point in value.split()]
+
+
+def parse(net_file) -> dict:
+    """
+    reads the fields used for trip generation from a net file without building a sumolib net.
+    The values are the same as extract(sumolib.net.readNet(net_file)) returns.
+    :param net_file: path to the .net.xml (or .net.xml.gz)
+    :return: dictionary of per edge columns and net wide values
+    """
+    import sumolib
+
+    all_classes = frozenset(sumolib.net.lane.SUMO_VEHICLE_CLASSES)
+    permissions = {}
+    columns = {"id": [], "from_coord": [], "to_coord": [], "length": [], "lanes": [], "speed": [], "allowed": [],
+               "fringe_incoming": [], "fringe_outgoing": [], "bbox": [], "params": []}
+    nodes = []
+    coords = {}
+    # edges which are not normal ones, connections from and to them don't count
+    special = set()
+    # ids of the edges with a connection from resp. to another normal edge which is not a turnaround
+    has_incoming = set()
+    has_outgoing = set()
+    boundary = None
+    ranges = [float("inf"), float("inf"), -float("inf"), -float("inf")]
+
+    edge = lanes = None
+    depth = 0
+    with sumolib.openz(net_file, "rb") as net_stream:
+        context = ElementTree.iterparse(net_stream, events=("start", "end"))
+        _, root = next(context)
+        for event, element in context:
+            if event == "end":
+                depth -= 1
+                if element.tag == "edge" and edge is not None:
+                    _add_edge(columns, nodes, permissions, edge, lanes)
+                    edge = None
+                if depth == 0:
+                    root.clear()
+                continue
+            depth += 1
+            tag = element.tag
+            if tag == "edge":
+                if element.get("function", "") == "":
+                    edge = {"id": element.get("id"), "from": element.get("from"), "to": element.get("to"),
+                            "params": None}
+                    lanes = []
+                else:
+                    special.add(element.get("id"))
+            elif tag == "lane" and edge is not None and depth == 2:
+                lanes.append((float(element.get("speed")), float(element.get("length")),
+                              _permissions(element.get("allow"), element.get("disallow"), all_classes),
+                              _shape(element.get("shape", ""))))
+            elif tag == "param" and edge is not None and depth == 2:
+                if edge["params"] is None:
+                    edge["params"] = {}
+                edge["params"][element.get("key")] = element.get("value")
+            elif tag == "junction" and depth == 1:
+                if element.get("id")[0] != ":":
+                    # like sumolib, z only if the junction has one
+                    coord = tuple(float(element.get(axis)) for axis in ("x", "y", "z") if element.get(axis) is not None)
+                    coords[element.get("id")] = coord
+                    ranges = [min(ranges[0], coord[0]), min(ranges[1], coord[1]),
+                              max(ranges[2], coord[0]), max(ranges[3], coord[1])]
+            elif tag == "connection" and depth == 1:
+                from_id, to_id = element.get("from"), element.get("to")
+                if from_id[0] != ":" and from_id not in special and to_id not in special and \
+                        element.get("dir") not in ("t", "T"):
+                    has_outgoing.add(from_id)
+                    has_incoming.add(to_id)
+            elif tag == "location" and depth == 1:
+                boundary = tuple(float(value) for value in element.get("convBoundary").split(","))
+
+    # junctions and connections follow the edges in the net file
+    for i, (from_id, to_id, shape) in enumerate(nodes):
+        from_coord, to_coord = coords[from_id], coords[to_id]
+        columns["from_coord"].append(from_coord)
+        columns["to_coord"].append(to_coord)
+        points = shape + [from_coord[:2], to_coord[:2]]
+        columns["bbox"].append((min(x for x, y in points), min(y for x, y in points),
+                                max(x for x, y in points), max(y for x, y in points)))
+        columns["fringe_incoming"].append(columns["id"][i] not in has_incoming)
+        columns["fringe_outgoing"].append(columns["id"][i] not in has_outgoing)
+
+    return {"version": CACHE_VERSION, "edges": columns, "boundary": boundary,
+            "bbox_diameter": ((ranges[2] - ranges[0]) ** 2 + (ranges[3] - ranges[1]) ** 2) ** 0.5}
+
+
+def _permissions(allow, disallow, all_classes):
+    # like sumolib.net.lane.get_allowed
+    if allow is None and disallow is None:
+        return all_classes
+    if disallow is None:
+        return frozenset(allow.split())
+    if disallow == "all":
+        return frozenset()
+    return all_classes.difference(disallow.split())
+
+
+def _add_edge(columns, nodes, permissions, edge, lanes):
+    # the columns known once the edge element is complete, the rest needs the junctions
+    allowed = frozenset().union(*[lane[2] for lane in lanes])
+    allowed = permissions.setdefault(allowed, allowed)
+    columns["id"].append(edge["id"])
+    # like sumolib, the length is the one of the first lane and the speed the one of the last
+    columns["length"].append(lanes[0][1])
+    columns["lanes"].append(len(lanes))
+    columns["speed"].append(lanes[-1][0])
+    columns["allowed"].append(allowed)
+    columns["params"].append(edge["params"])
+    # shape of the edge as sumolib builds it, the middle lane or the mean of the lanes
+    if len(lanes) % 2 == 1:
+        shape = lanes[len(lanes) // 2][3]
+    else:
+        points = min(len(lane[3]) for lane in lanes)
+        shape = [(sum(lane[3][i][0] for lane in lanes) / len(lanes), sum(lane[3][i][1] for lane in lanes) / len(lanes))
+                 for i in range(points)]
+    nodes.append((edge["from"], edge["to"], shape))
+
+
+def build(data) -> CachedNet:
+    """
+    turns extracted net data into edge and net objects usable by randomTrips.py
+    :param data: dictionary as returned by extract or parse
+    :return: CachedNet
+    """
+    columns = data["edges"]
+    no_params = {}
+    # edges starting or ending at the same junction share its node
+    nodes = {}
+    edges = [CachedEdge(id, nodes.setdefault(from_coord, CachedNode(from_coord)),
+                        nodes.setdefault(to_coord, CachedNode(to_coord)), *fields[:-1],
+                        fields[-1] if fields[-1] is not None else no_params)
+             for id, from_coord, to_coord, *fields in zip(
+                 columns["id"], columns["from_coord"], columns["to_coord"], columns["length"], columns["lanes"],
+                 columns["speed"], columns["allowed"], columns["fringe_incoming"], columns["fringe_outgoing"],
+                 columns["bbox"], columns["params"])]
+    return CachedNet(edges, data["boundary"], data["bbox_diameter"])
+
+
+def read_net(net_file) -> CachedNet:
+    """
+    compact net for trip generation, read from the net file without building a sumolib net
+    :param net_file: path to the .net.xml (or .net.xml.gz)
+    :return: CachedNet
+    """
+    return build(parse(net_file))
+
+
+def load_net(net_file, cache_dir, verbose=False) -> CachedNet:
+    """
+    loads the trip generation fields of a net from cache_dir, parsing and caching the net first if needed.
+    The cache entry is keyed by the content hash of the net file, so a changed net is parsed again.
+    :param net_file: path to the .net.xml
+    :param cache_dir: directory for the cache files, created if missing
+    :param verbose: print whether the cache was used
+    :return: CachedNet
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    # hashing the net takes a fraction of the time parsing it does, and unlike its size and modification
+    # time the content hash can't miss a net rewritten in place
+    digest = net_digest(net_file)
+    cache_path = os.path.join(cache_dir, "%s.v%s.pickle" % (digest, CACHE_VERSION))
+
+    if os.path.isfile(cache_path):
+        try:
+            with open(cache_path, "rb") as file:
+                data = pickle.load(file)
+            if verbose:
+                print("loaded net from cache", cache_path)
+            return build(data)
+        except (OSError, pickle.UnpicklingError, EOFError, KeyError):
+            # broken cache file, parse again and overwrite it
+            pass
+
+    data = parse(net_file)
+    tmp_path = cache_path + ".%s.tmp" % os.getpid()
+    with open(tmp_path, "wb") as file:
+        pickle.dump(data, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
+    if verbose:
+        print("wrote net cache", cache_path)
+    return build(data)
@@ -22,18 +22,31 @@ import sys
 import random
 import bisect
 import subprocess
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import math
 import optparse
+import hashlib
+import pickle
+import weakref
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 if 'SUMO_HOME' in os.environ:
     sys.path.append(os.path.join(os.environ['SUMO_HOME'], 'tools'))
 import sumolib  # noqa
 from sumolib.miscutils import euclidean  # noqa
 from sumolib.geomhelper import naviDegree, minAngleDegreeDiff  # noqa
+import net_cache  # noqa
+import instrumentation  # noqa
+from demand_profile import DemandProfile  # noqa
 
 DUAROUTER = sumolib.checkBinary('duarouter')
 
+# number of edge generator sets kept per loaded net
+GENERATOR_CACHE_SIZE = 16
+
 SOURCE_SUFFIX = ".src.xml"
 SINK_SUFFIX = ".dst.xml"
 VIA_SUFFIX = ".via.xml"
@@ -43,6 +56,12 @@ def get_options(args=None):
     optParser = optparse.OptionParser()
     optParser.add_option("-n", "--net-file", dest="netfile",
                          help="define the net file (mandatory)")
+    optParser.add_option("--net-cache", dest="net_cache",
+                         help="cache the edge data needed for trip generation in the given directory, " +
+                         "keyed by the content hash of the net file")
+    optParser.add_option("--compact-net", dest="compact_net", action="store_true", default=False,
+                         help="read only the edge data needed for trip generation from the net file " +
+                         "instead of loading the full sumolib net")
     optParser.add_option("-a", "--additional-files", dest="additional",
                          help="define additional files to be loaded by the router")
     optParser.add_option("-o", "--output-trip-file", dest="tripfile",
@@ -54,6 +73,9 @@ def get_options(args=None):
     optParser.add_option("--weights-prefix", dest="weightsprefix",
                          help="loads probabilities for being source, destination and via-edge from the files named " +
                          "<prefix>.src.xml, <prefix>.sink.xml and <prefix>.via.xml")
+    optParser.add_option("--generator-cache", dest="generator_cache",
+                         help="store the source, sink and via weights in the given directory and reuse them for " +
+                         "the same net and weight options")
     optParser.add_option("--weights-output-prefix", dest="weights_outprefix",
                          help="generates weights files for visualisation")
     optParser.add_option("--pedestrians", action="store_true",
@@ -77,6 +99,12 @@ def get_options(args=None):
     optParser.add_option(
         "-p", "--period", type="float", default=1, help="Generate vehicles with equidistant departure times and " +
         "period=FLOAT (default 1.0). If option --binomial is used, the expected arrival rate is set to 1/period.")
+    optParser.add_option("--profile", dest="profile",
+                         help="distribute the departures between begin and end following the demand profile in the " +
+                         "given file instead of equidistantly. The number of departures is (end - begin) / period")
+    optParser.add_option("--profile-poisson", dest="profile_poisson", action="store_true", default=False,
+                         help="draw the departures of --profile from a non-homogeneous poisson process instead of " +
+                         "spacing them evenly over the cumulative demand")
     optParser.add_option("-s", "--seed", type="int", help="random seed")
     optParser.add_option("-l", "--length", action="store_true",
                          default=False, help="weight edge probability by length")
@@ -127,6 +155,16 @@ def get_options(args=None):
                          default=False, help="Remove loops at route start and end")
     optParser.add_option("--validate", default=False, action="store_true",
                          help="Whether to produce trip output that is already checked for connectivity")
+    optParser.add_option("--batch-size", type="int", dest="batch_size",
+                         default=0, help="draw the edges of INT trips at once using numpy instead of one trip at a " +
+                         "time (default 0, disabled). The trips differ from the ones drawn for the same seed without " +
+                         "this option. Not used together with --flows")
+    optParser.add_option("--compact-xml", dest="compact_xml", action="store_true", default=False,
+                         help="write the trips without indentation")
+    optParser.add_option("--instrument", dest="instrument", metavar="FILE",
+                         help="write the time spent in every stage and counters of the run as JSON report to FILE")
+    optParser.add_option("--cprofile", dest="cprofile", metavar="FILE",
+                         help="write a cProfile dump of the run to FILE")
     optParser.add_option("-v", "--verbose", action="store_true",
                          default=False, help="tell me what you are doing")
     (options, args) = optParser.parse_args(args=args)
@@ -150,6 +188,16 @@ def get_options(args=None):
         print("Error: Period must be positive", file=sys.stderr)
         sys.exit(1)
 
+    if options.profile:
+        if options.flows > 0 or options.binomial:
+            print("Error: Option --profile cannot be used together with --flows or --binomial", file=sys.stderr)
+            sys.exit(1)
+        if np is None:
+            print("Error: Option --profile requires numpy", file=sys.stderr)
+            sys.exit(1)
+        if options.batch_size <= 0:
+            options.batch_size = 10000
+
     if options.jtrrouter and options.flows <= 0:
         print("Error: Option --jtrrouter must be used with option --flows", file=sys.stderr)
         sys.exit(1)
@@ -176,15 +224,26 @@ class InvalidGenerator(Exception):
 
 class RandomEdgeGenerator:
 
-    def __init__(self, net, weight_fun):
+    def __init__(self, net, weight_fun=None, weights=None):
+        # the weights are either given as array (see get_prob_array) or computed per edge by weight_fun
         self.net = net
         self.weight_fun = weight_fun
-        self.cumulative_weights = []
-        self.total_weight = 0
-        for edge in self.net._edges:
-            # print edge.getID(), weight_fun(edge)
-            self.total_weight += weight_fun(edge)
-            self.cumulative_weights.append(self.total_weight)
+        if weights is not None:
+            self.weights = weights
+            self._cumulative_array = np.cumsum(weights)
+            self.cumulative_weights = self._cumulative_array.tolist()
+            self.total_weight = self.cumulative_weights[-1] if self.cumulative_weights else 0
+        else:
+            self.weights = []
+            self.cumulative_weights = []
+            self.total_weight = 0
+            for edge in self.net._edges:
+                # print edge.getID(), weight_fun(edge)
+                weight = weight_fun(edge)
+                self.weights.append(weight)
+                self.total_weight += weight
+                self.cumulative_weights.append(self.total_weight)
+            self._cumulative_array = None
         if self.total_weight == 0:
             raise InvalidGenerator()
 
@@ -193,10 +252,19 @@ class RandomEdgeGenerator:
         index = bisect.bisect(self.cumulative_weights, r)
         return self.net._edges[index]
 
+    def get_indices(self, rng, n):
+        # draws n edge indices at once from the numpy generator rng
+        if self._cumulative_array is None:
+            self._cumulative_array = np.array(self.cumulative_weights)
+        r = rng.random(n) * self.total_weight
+        indices = np.searchsorted(self._cumulative_array, r, side="right")
+        return np.minimum(indices, len(self._cumulative_array) - 1)
+
     def write_weights(self, fname):
         # normalize to [0,100]
-        normalizer = 100.0 / max(1, max(map(self.weight_fun, self.net._edges)))
-        weights = [(self.weight_fun(e) * normalizer, e.getID()) for e in self.net.getEdges()]
+        weights = list(self.weights)
+        normalizer = 100.0 / max(1, max(weights))
+        weights = [(w * normalizer, e.getID()) for w, e in zip(weights, self.net.getEdges())]
         weights.sort(reverse=True)
         with open(fname, 'w+') as f:
             f.write('<edgedata>\n')
@@ -216,9 +284,16 @@ class RandomTripGenerator:
         self.via_generator = via_generator
         self.intermediate = intermediate
         self.pedestrians = pedestrians
+        # node coordinates of all edges for the batched distance checks
+        self._from_coords = None
+        self._to_coords = None
+        # candidate trips drawn and rejected by get_trips
+        self.candidates = 0
+        self.rejected = 0
 
     def get_trip(self, min_distance, max_distance, maxtries=100):
         for i in range(maxtries):
+            self.candidates += 1
             source_edge = self.source_generator.get()
             intermediate = [self.via_generator.get()
                             for i in range(self.intermediate)]
@@ -235,8 +310,101 @@ class RandomTripGenerator:
                             for p, q in zip(coords[:-1], coords[1:])])
             if distance >= min_distance and (max_distance is None or distance < max_distance):
                 return source_edge, sink_edge, intermediate
+            self.rejected += 1
         raise Exception("no trip found after %s tries" % maxtries)
 
+    def get_trips(self, rng, n, min_distance=0.0, max_distance=None, maxtries=100):
+        # draws n trips at once, returning the source, sink and via edge indices in arrays of
+        # shape (n,), (n,) and (n, intermediate) and a mask of the trips which meet the distance
+        # constraints. Only the rejected trips are drawn again, up to maxtries times.
+        sources = self.source_generator.get_indices(rng, n)
+        vias = self._get_vias(rng, n)
+        sinks = self.sink_generator.get_indices(rng, n)
+        found = np.ones(n, dtype=bool)
+        if min_distance <= 0 and max_distance is None:
+            self.candidates += n
+            return sources, sinks, vias, found
+
+        pending = np.arange(n)
+        for i in range(maxtries):
+            self.candidates += len(pending)
+            distance = self._get_distances(sources[pending], vias[pending], sinks[pending])
+            accepted = distance >= min_distance
+            if max_distance is not None:
+                accepted &= distance < max_distance
+            pending = pending[~accepted]
+            self.rejected += len(pending)
+            if len(pending) == 0:
+                break
+            if i + 1 < maxtries:
+                sources[pending] = self.source_generator.get_indices(rng, len(pending))
+                vias[pending] = self._get_vias(rng, len(pending))
+                sinks[pending] = self.sink_generator.get_indices(rng, len(pending))
+        found[pending] = False
+        return sources, sinks, vias, found
+
+    def _get_vias(self, rng, n):
+        if self.intermediate > 0:
+            return self.via_generator.get_indices(rng, n * self.intermediate).reshape(n, self.intermediate)
+        return np.empty((n, 0), dtype=np.intp)
+
+    def _get_distances(self, sources, vias, sinks):
+        # length of the straight lines from the start of the source edge over the start of the via
+        # edges to the end of the sink edge (its start for pedestrians), as in get_trip
+        if self._from_coords is None:
+            edges = self.source_generator.net.getEdges()
+            self._from_coords = np.array([e.getFromNode().getCoord()[:2] for e in edges], dtype=float)
+            self._to_coords = np.array([e.getToNode().getCoord()[:2] for e in edges], dtype=float)
+        dest_coords = self._from_coords if self.pedestrians else self._to_coords
+        points = np.concatenate((self._from_coords[sources][:, None],
+                                 self._from_coords[vias],
+                                 dest_coords[sinks][:, None]), axis=1)
+        return np.hypot(*np.diff(points, axis=1).transpose(2, 0, 1)).sum(axis=1)
+
+
+class TripWriter:
+    # renders batches of trips or persons as drawn by RandomTripGenerator.get_trips and writes each
+    # batch at once. The edge ids and attribute strings are prepared once for all batches.
+
+    def __init__(self, fouttrips, edges, options, personattrs, otherattrs):
+        self.fouttrips = fouttrips
+        self.edge_ids = [e.getID() for e in edges]
+        self.prefix = options.tripprefix
+        self.attrs = options.tripattrs
+        self.fringe_attrs = options.tripattrs + " " + options.fringeattrs
+        if options.fringeattrs:
+            self.fringe_sources = [e.is_fringe(e._incoming) for e in edges]
+        else:
+            self.fringe_sources = None
+        indent = "" if options.compact_xml else "    "
+        self.pedestrians = options.pedestrians
+        self.trip_format = indent + '<trip id="%s%s" depart="%.2f" from="%s" to="%s"%s%s/>\n'
+        walk = "personTrip" if options.persontrips else "walk"
+        self.person_format = (indent + '<person id="%s%s" depart="%.2f"%s>\n' +
+                              indent * 2 + '<' + walk + ' from="%s" to="%s"%s/>\n' +
+                              indent + '</person>\n')
+        self.personattrs = personattrs
+        self.otherattrs = otherattrs
+
+    def write(self, idx, departs, sources, sinks, vias, found):
+        # writes the found trips, the trip at position i gets the label prefix + (idx + i)
+        # returns the index following the batch
+        ids = self.edge_ids
+        lines = []
+        for i, (depart, source, sink, via, ok) in enumerate(zip(departs.tolist(), sources.tolist(), sinks.tolist(),
+                                                                 vias.tolist(), found.tolist())):
+            if not ok:
+                continue
+            if self.pedestrians:
+                lines.append(self.person_format % (self.prefix, idx + i, depart, self.personattrs,
+                                                   ids[source], ids[sink], self.otherattrs))
+                continue
+            via = ' via="%s" ' % ' '.join([ids[e] for e in via]) if via else ""
+            attrs = self.fringe_attrs if self.fringe_sources and self.fringe_sources[source] else self.attrs
+            lines.append(self.trip_format % (self.prefix, idx + i, depart, ids[source], ids[sink], via, attrs))
+        self.fouttrips.write("".join(lines))
+        return idx + len(departs)
+
 
 def get_prob_fun(options, fringe_bonus, fringe_forbidden):
     # fringe_bonus None generates intermediate way points
@@ -284,6 +452,119 @@ def get_prob_fun(options, fringe_bonus, fringe_forbidden):
     return edge_probability
 
 
+class EdgeTable:
+    # the edge attributes used by get_prob_array as arrays in the order of net.getEdges().
+    # Attributes which need a pass over the edge objects are only collected when first used.
+
+    def __init__(self, net):
+        self.edges = net.getEdges()
+        self.length = np.array([e.getLength() for e in self.edges], dtype=float)
+        self.lanes = np.array([e.getLaneNumber() for e in self.edges], dtype=float)
+        self.speed = np.array([e.getSpeed() for e in self.edges], dtype=float)
+        self._fringe = {}
+        self._allows = {}
+        self._params = {}
+        self._angles = {}
+
+    def fringe(self, side=None):
+        # side is None (any), "_incoming" or "_outgoing", as for edge.is_fringe
+        if side not in self._fringe:
+            if side is None:
+                self._fringe[side] = self.fringe("_incoming") | self.fringe("_outgoing")
+            else:
+                self._fringe[side] = np.array([e.is_fringe(getattr(e, side)) for e in self.edges], dtype=bool)
+        return self._fringe[side]
+
+    def allows(self, vclass):
+        if vclass not in self._allows:
+            self._allows[vclass] = np.array([e.allows(vclass) for e in self.edges], dtype=bool)
+        return self._allows[vclass]
+
+    def param(self, key):
+        if key not in self._params:
+            self._params[key] = np.array([float(e.getParam(key, 1.0)) for e in self.edges], dtype=float)
+        return self._params[key]
+
+    def angles(self, center):
+        # navigation angle of each edge's bounding box center seen from center, computed with the
+        # same scalar functions as in get_prob_fun so the weights stay identical
+        if center not in self._angles:
+            nx, ny = center
+            angles = []
+            for edge in self.edges:
+                xmin, ymin, xmax, ymax = edge.getBoundingBox()
+                ex, ey = ((xmin + xmax) / 2, (ymin + ymax) / 2)
+                angles.append(naviDegree(math.atan2(ey - ny, ex - nx)))
+            self._angles[center] = np.array(angles, dtype=float)
+        return self._angles[center]
+
+
+# edge tables of the nets loaded in this process, shared by all generators of a net
+_edge_tables = weakref.WeakKeyDictionary()
+
+
+def get_edge_table(net):
+    if net not in _edge_tables:
+        _edge_tables[net] = EdgeTable(net)
+    return _edge_tables[net]
+
+
+def _normalize_angles(a, lower, upper, circle):
+    # array version of sumolib.geomhelper.normalizeAngle
+    a = a.copy()
+    while (a < lower).any():
+        a[a < lower] += circle
+    while (a >= upper).any():
+        a[a >= upper] -= circle
+    return a
+
+
+def get_prob_array(options, fringe_bonus, fringe_forbidden, table):
+    # weights of all edges at once, with the same results as the edge_probability closure of get_prob_fun
+    excluded = np.zeros(len(table.edges), dtype=bool)
+    if options.vclass:
+        excluded |= ~table.allows(options.vclass)  # not allowed
+    if fringe_bonus is None and not options.pedestrians:
+        excluded |= table.fringe()  # not suitable as intermediate way point
+    if fringe_forbidden is not None and not options.pedestrians:
+        wrong_fringe = table.fringe(fringe_forbidden)
+        if options.allow_fringe_min_length is not None:
+            wrong_fringe = wrong_fringe & (table.length < options.allow_fringe_min_length)
+        excluded |= wrong_fringe  # the wrong kind of fringe
+    prob = np.ones(len(table.edges), dtype=float)
+    if options.length:
+        prob *= table.length
+    if options.lanes:
+        prob *= table.lanes
+    prob *= (table.speed ** options.speed_exponent)
+    if (options.fringe_factor != 1.0 and
+            not options.pedestrians and
+            fringe_bonus is not None):
+        bonus = (table.speed > options.fringe_threshold) & table.fringe(fringe_bonus)
+        prob[bonus] *= options.fringe_factor
+    if options.edgeParam is not None:
+        prob *= table.param(options.edgeParam)
+    if options.angle_weight != 1.0 and fringe_bonus is not None:
+        edgeAngle = table.angles(tuple(options.angle_center))
+        angleDiff = np.minimum(_normalize_angles(options.angle - edgeAngle, 0, 360, 360),
+                               _normalize_angles(edgeAngle - options.angle, 0, 360, 360))
+        if fringe_bonus == "_incoming":
+            # source edge
+            prob *= (angleDiff * (options.angle_weight - 1) + 1)
+        else:
+            prob *= ((180 - angleDiff) * (options.angle_weight - 1) + 1)
+    prob[excluded] = 0
+    return prob
+
+
+def build_edge_generator(net, options, fringe_bonus, fringe_forbidden):
+    # uses the array weights if numpy is available and the per edge closure otherwise
+    if np is not None:
+        return RandomEdgeGenerator(
+            net, weights=get_prob_array(options, fringe_bonus, fringe_forbidden, get_edge_table(net)))
+    return RandomEdgeGenerator(net, get_prob_fun(options, fringe_bonus, fringe_forbidden))
+
+
 class LoadedProps:
 
     def __init__(self, fname):
@@ -295,39 +576,114 @@ class LoadedProps:
         return self.weights[edge.getID()]
 
 
+def build_edge_generators(net, options):
+    # returns the source, sink and via generators, via is None if there are no valid via edges.
+    # Raises InvalidGenerator if there are no valid source or sink edges
+    forbidden_source_fringe = None if options.allow_fringe else "_outgoing"
+    forbidden_sink_fringe = None if options.allow_fringe else "_incoming"
+    source_generator = build_edge_generator(net, options, "_incoming", forbidden_source_fringe)
+    sink_generator = build_edge_generator(net, options, "_outgoing", forbidden_sink_fringe)
+    if options.weightsprefix:
+        if os.path.isfile(options.weightsprefix + SOURCE_SUFFIX):
+            source_generator = RandomEdgeGenerator(
+                net, LoadedProps(options.weightsprefix + SOURCE_SUFFIX))
+        if os.path.isfile(options.weightsprefix + SINK_SUFFIX):
+            sink_generator = RandomEdgeGenerator(
+                net, LoadedProps(options.weightsprefix + SINK_SUFFIX))
+
+    try:
+        via_generator = build_edge_generator(net, options, None, None)
+        if options.weightsprefix and os.path.isfile(options.weightsprefix + VIA_SUFFIX):
+            via_generator = RandomEdgeGenerator(
+                net, LoadedProps(options.weightsprefix + VIA_SUFFIX))
+    except InvalidGenerator:
+        via_generator = None
+    return source_generator, sink_generator, via_generator
+
+
+def weight_key(options):
+    # all options the edge weights depend on, the net itself is not included
+    key = (options.vclass, options.pedestrians, options.allow_fringe, options.allow_fringe_min_length,
+           options.length, options.lanes, options.speed_exponent, options.fringe_factor, options.fringe_threshold,
+           options.edgeParam, options.angle, options.angle_weight, getattr(options, "angle_center", None))
+    if options.weightsprefix:
+        # weight files are identified by their content
+        for suffix in (SOURCE_SUFFIX, SINK_SUFFIX, VIA_SUFFIX):
+            fname = options.weightsprefix + suffix
+            key += (net_cache.net_digest(fname) if os.path.isfile(fname) else None,)
+    return key
+
+
+# edge generators of the nets loaded in this process, an LRU ordered dictionary per net
+_generator_cache = weakref.WeakKeyDictionary()
+
+
+def get_edge_generators(net, options):
+    # build_edge_generators, memoized in process for the net object and
+    # on disk for the content of the net file if options.generator_cache is set
+    key = weight_key(options)
+    cache = _generator_cache.setdefault(net, OrderedDict())
+    if key in cache:
+        cache.move_to_end(key)
+        generators = cache[key]
+    else:
+        # the net file is hashed once for loading and storing
+        path = _generator_cache_path(options, key) if options.generator_cache and np is not None else None
+        generators = _load_edge_generators(net, options, key, path)
+        if generators is None:
+            generators = build_edge_generators(net, options)
+            _store_edge_generators(key, generators, path)
+        cache[key] = generators
+        if len(cache) > GENERATOR_CACHE_SIZE:
+            cache.popitem(last=False)
+    return generators
+
+
+def _generator_cache_path(options, key):
+    # keyed by the content of the net, a net rewritten with the same size and time stamp gets other weights
+    os.makedirs(options.generator_cache, exist_ok=True)
+    digest = net_cache.net_digest(options.netfile)
+    key_digest = hashlib.sha256(repr(key).encode()).hexdigest()[:16]
+    return os.path.join(options.generator_cache, "%s.%s.weights.pickle" % (digest, key_digest))
+
+
+def _load_edge_generators(net, options, key, path):
+    if path is None or not os.path.isfile(path):
+        return None
+    try:
+        with open(path, "rb") as f:
+            stored_key, weights = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+        return None
+    if stored_key != key:
+        return None
+    if options.verbose:
+        print("loaded edge weights from", path)
+    return tuple(RandomEdgeGenerator(net, weights=w) if w is not None else None for w in weights)
+
+
+def _store_edge_generators(key, generators, path):
+    if path is None:
+        return
+    weights = tuple(np.asarray(g.weights, dtype=float) if g is not None else None for g in generators)
+    tmp_path = path + ".%s.tmp" % os.getpid()
+    with open(tmp_path, "wb") as f:
+        pickle.dump((key, weights), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
 def buildTripGenerator(net, options):
     try:
-        forbidden_source_fringe = None if options.allow_fringe else "_outgoing"
-        forbidden_sink_fringe = None if options.allow_fringe else "_incoming"
-        source_generator = RandomEdgeGenerator(
-            net, get_prob_fun(options, "_incoming", forbidden_source_fringe))
-        sink_generator = RandomEdgeGenerator(
-            net, get_prob_fun(options, "_outgoing", forbidden_sink_fringe))
-        if options.weightsprefix:
-            if os.path.isfile(options.weightsprefix + SOURCE_SUFFIX):
-                source_generator = RandomEdgeGenerator(
-                    net, LoadedProps(options.weightsprefix + SOURCE_SUFFIX))
-            if os.path.isfile(options.weightsprefix + SINK_SUFFIX):
-                sink_generator = RandomEdgeGenerator(
-                    net, LoadedProps(options.weightsprefix + SINK_SUFFIX))
+        source_generator, sink_generator, via_generator = get_edge_generators(net, options)
     except InvalidGenerator:
         print("Error: no valid edges for generating source or destination. Try using option --allow-fringe",
               file=sys.stderr)
         return None
 
-    try:
-        via_generator = RandomEdgeGenerator(
-            net, get_prob_fun(options, None, None))
-        if options.weightsprefix and os.path.isfile(options.weightsprefix + VIA_SUFFIX):
-            via_generator = RandomEdgeGenerator(
-                net, LoadedProps(options.weightsprefix + VIA_SUFFIX))
-    except InvalidGenerator:
-        if options.intermediate > 0:
-            print(
-                "Error: no valid edges for generating intermediate points", file=sys.stderr)
-            return None
-        else:
-            via_generator = None
+    if via_generator is None and options.intermediate > 0:
+        print(
+            "Error: no valid edges for generating intermediate points", file=sys.stderr)
+        return None
 
     return RandomTripGenerator(
         source_generator, sink_generator, via_generator, options.intermediate, options.pedestrians)
@@ -414,11 +770,56 @@ def prependSpace(s):
         return " " + s
 
 
-def main(options):
+def _accumulate(begin, end, step, size):
+    # yields begin, begin + step, ... below end in arrays of size entries, every value is the previous one plus step
+    # like depart += period in the loop of main, also across arrays
+    current = begin
+    while current < end:
+        times = np.cumsum(np.concatenate(([current], np.full(size - 1, step, dtype=float))))
+        times = times[times < end]
+        yield times
+        current = times[-1] + step
+
+
+def get_departs(options, rng):
+    # yields the departure times between begin and end in arrays of batch_size entries, only the last one may be
+    # shorter. The arrays are generated one at a time, so the times of a run are never all in memory.
+    # the times are accumulated like in the loop of main, so they are equal to the ones without batches
+    if options.profile:
+        profile = DemandProfile.load(options.profile).clip(options.begin, options.end)
+        # rounded first, so a period dividing the time span exactly gives no extra departure
+        count = int(math.ceil(round((options.end - options.begin) / options.period, 9)))
+        yield from profile.departures(count, rng, options.profile_poisson, options.batch_size)
+        return
+    if options.binomial is None:
+        yield from _accumulate(options.begin, options.end, options.period, options.batch_size)
+        return
+    # draw the number of departures per second from a binomial distribution
+    # for an average arrival rate of 1 / period
+    prob = 1.0 / options.period / options.binomial
+    pending = np.empty(0)
+    for seconds in _accumulate(options.begin, options.end, 1, options.batch_size):
+        pending = np.concatenate((pending, np.repeat(seconds, rng.binomial(options.binomial, prob, len(seconds)))))
+        while len(pending) >= options.batch_size:
+            yield pending[:options.batch_size]
+            pending = pending[options.batch_size:]
+    if len(pending):
+        yield pending
+
+
+# net may be passed in by callers which generate several trip files for the same network
+def main(options, net=None):
     if options.seed:
         random.seed(options.seed)
 
-    net = sumolib.net.readNet(options.netfile)
+    if net is None:
+        with instrumentation.stage("net_load"):
+            if options.net_cache:
+                net = net_cache.load_net(options.netfile, options.net_cache, options.verbose)
+            elif options.compact_net:
+                net = net_cache.read_net(options.netfile)
+            else:
+                net = sumolib.net.readNet(options.netfile)
     if options.min_distance > net.getBBoxDiameter() * (options.intermediate + 1):
         options.intermediate = int(
             math.ceil(options.min_distance / net.getBBoxDiameter())) - 1
@@ -430,19 +831,32 @@ def main(options):
         xmin, ymin, xmax, ymax = net.getBoundary()
         options.angle_center = (xmin + xmax) / 2, (ymin + ymax) / 2
 
-    trip_generator = buildTripGenerator(net, options)
+    with instrumentation.stage("build_generator"):
+        trip_generator = buildTripGenerator(net, options)
     idx = 0
 
     vtypeattrs, options.tripattrs, personattrs, otherattrs = split_trip_attributes(
         options.tripattrs, options.pedestrians, options.vehicle_class)
 
     vias = {}
+    indent = "" if options.compact_xml else "    "
 
     def generate_one(idx):
+        try:
+            with instrumentation.stage("sampling"):
+                source_edge, sink_edge, intermediate = trip_generator.get_trip(
+                    options.min_distance, options.max_distance, options.maxtries)
+        except Exception as exc:
+            print(exc, file=sys.stderr)
+            instrumentation.count("get_trip_failures")
+            return idx + 1
+        with instrumentation.stage("writing"):
+            return write_one(idx, source_edge, sink_edge, intermediate)
+
+    # writes the trip, person or flow with the given edges departing at the current value of depart
+    def write_one(idx, source_edge, sink_edge, intermediate):
         label = "%s%s" % (options.tripprefix, idx)
         try:
-            source_edge, sink_edge, intermediate = trip_generator.get_trip(
-                options.min_distance, options.max_distance, options.maxtries)
             combined_attrs = options.tripattrs
             if options.fringeattrs and source_edge.is_fringe(source_edge._incoming):
                 combined_attrs += " " + options.fringeattrs
@@ -454,30 +868,32 @@ def main(options):
                     vias[label] = via
             if options.pedestrians:
                 fouttrips.write(
-                    '    <person id="%s" depart="%.2f"%s>\n' % (label, depart, personattrs))
+                    indent + '<person id="%s" depart="%.2f"%s>\n' % (label, depart, personattrs))
                 if options.persontrips:
                     fouttrips.write(
-                        '        <personTrip from="%s" to="%s"%s/>\n' % (
+                        indent * 2 + '<personTrip from="%s" to="%s"%s/>\n' % (
                             source_edge.getID(), sink_edge.getID(), otherattrs))
                 else:
                     fouttrips.write(
-                        '        <walk from="%s" to="%s"%s/>\n' % (source_edge.getID(), sink_edge.getID(), otherattrs))
-                fouttrips.write('    </person>\n')
+                        indent * 2 + '<walk from="%s" to="%s"%s/>\n' % (
+                            source_edge.getID(), sink_edge.getID(), otherattrs))
+                fouttrips.write(indent + '</person>\n')
             elif options.flows > 0:
                 to = '' if options.jtrrouter else ' to="%s"' % sink_edge.getID()
                 if options.binomial:
                     for j in range(options.binomial):
-                        fouttrips.write(('    <flow id="%s#%s" begin="%s" end="%s" probability="%s" ' +
+                        fouttrips.write((indent + '<flow id="%s#%s" begin="%s" end="%s" probability="%s" ' +
                                          'from="%s"%s%s%s/>\n') % (
                             label, j, options.begin, options.end, 1.0 / options.period / options.binomial,
                             source_edge.getID(), to, via, combined_attrs))
                 else:
-                    fouttrips.write(('    <flow id="%s" begin="%s" end="%s" period="%s" from="%s"%s%s%s/>\n') % (
+                    fouttrips.write((indent + '<flow id="%s" begin="%s" end="%s" period="%s" from="%s"%s%s%s/>\n') % (
                         label, options.begin, options.end, options.period * options.flows, source_edge.getID(),
                         to, via, combined_attrs))
             else:
-                fouttrips.write('    <trip id="%s" depart="%.2f" from="%s" to="%s"%s%s/>\n' % (
+                fouttrips.write(indent + '<trip id="%s" depart="%.2f" from="%s" to="%s"%s%s/>\n' % (
                     label, depart, source_edge.getID(), sink_edge.getID(), via, combined_attrs))
+            instrumentation.count("trips")
         except Exception as exc:
             print(exc, file=sys.stderr)
         return idx + 1
@@ -485,12 +901,36 @@ def main(options):
     with open(options.tripfile, 'w') as fouttrips:
         sumolib.writeXMLHeader(fouttrips, "$Id$", "routes")  # noqa
         if options.vehicle_class:
-            fouttrips.write('    <vType id="%s" vClass="%s"%s/>\n' %
+            fouttrips.write(indent + '<vType id="%s" vClass="%s"%s/>\n' %
                             (options.vtypeID, options.vehicle_class, vtypeattrs))
             options.tripattrs += ' type="%s"' % options.vtypeID
             personattrs += ' type="%s"' % options.vtypeID
         depart = options.begin
-        if trip_generator:
+        use_batches = options.batch_size > 0 and options.flows == 0
+        if use_batches and np is None:
+            print("Warning: numpy is not available, generating one trip at a time", file=sys.stderr)
+            use_batches = False
+        if trip_generator and use_batches:
+            rng = np.random.default_rng(options.seed)
+            writer = TripWriter(fouttrips, net.getEdges(), options, personattrs, otherattrs)
+            missing = 0
+            for departs in get_departs(options, rng):
+                with instrumentation.stage("sampling"):
+                    sources, sinks, vias, found = trip_generator.get_trips(
+                        rng, len(departs), options.min_distance, options.max_distance, options.maxtries)
+                with instrumentation.stage("writing"):
+                    idx = writer.write(idx, departs, sources, sinks, vias, found)
+                missing += len(found) - int(found.sum())
+                instrumentation.count("trips", int(found.sum()))
+            instrumentation.count("get_trip_failures", missing)
+            if missing:
+                print("Warning: no trip found after %s tries for %s departures" % (options.maxtries, missing),
+                      file=sys.stderr)
+            if options.verbose and trip_generator.candidates:
+                print("rejected %s of %s candidate trips (%.2f%%)" % (
+                    trip_generator.rejected, trip_generator.candidates,
+                    100.0 * trip_generator.rejected / trip_generator.candidates))
+        elif trip_generator:
             if options.flows == 0:
                 while depart < options.end:
                     if options.binomial is None:
@@ -510,6 +950,10 @@ def main(options):
                     idx = generate_one(idx)
 
         fouttrips.write("</routes>\n")
+        instrumentation.count("bytes_written", fouttrips.tell())
+    if trip_generator:
+        instrumentation.count("get_trip_attempts", trip_generator.candidates)
+        instrumentation.count("get_trip_rejected", trip_generator.rejected)
 
     # call duarouter for routes or validated trips
     args = [DUAROUTER, '-n', options.netfile, '-r', options.tripfile, '--ignore-errors',
@@ -527,14 +971,16 @@ def main(options):
     if options.routefile:
         args2 = args + ['-o', options.routefile]
         print("calling ", " ".join(args2))
-        subprocess.call(args2)
+        with instrumentation.stage("duarouter"):
+            subprocess.call(args2)
 
     if options.validate:
         # write to temporary file because the input is read incrementally
         tmpTrips = options.tripfile + ".tmp"
         args2 = args + ['-o', tmpTrips, '--write-trips']
         print("calling ", " ".join(args2))
-        subprocess.call(args2)
+        with instrumentation.stage("duarouter"):
+            subprocess.call(args2)
         os.remove(options.tripfile)  # on windows, rename does not overwrite
         os.rename(tmpTrips, options.tripfile)
 
@@ -552,5 +998,6 @@ def main(options):
 
 
 if __name__ == "__main__":
-    if not main(get_options()):
+    options = get_options()
+    if not instrumentation.run("randomTrips", options.instrument, options.cprofile, main, options):
         sys.exit(1)
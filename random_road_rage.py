@@ -7,17 +7,242 @@
 # author: Daniel Ostertag, Daniel Habermayr
 
 import argparse
+import functools
+import hashlib
 import os
+import shutil
+import subprocess
 import sys
-from xml.dom import minidom
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
 from random import randint
 from colorama import Fore
 
+import instrumentation
+import demand_profile
+import net_cache
+import randomTrips
+import trip_meta
+from demand_profile import DemandProfile
+
+# net of the current process, loaded once per worker by _init_worker
+_worker_net = None
+
+# trips drawn at once by randomTrips, if numpy is available
+BATCH_SIZE = 10000
+
+# bump when the output of a work unit changes for the same inputs, invalidates the unit cache
+UNIT_CACHE_VERSION = 1
+
+# rush hour profile used if no other one is given
+DEFAULT_PROFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rush_hours.profile")
+
+# one randomTrips run: a vehicle type in one interval, or in the whole profile if profile is set
+WorkUnit = namedtuple("WorkUnit", ["vehicle", "v_class", "idx", "begin", "end", "period", "fringe", "seed", "net_file",
+                                   "net_cache_dir", "profile", "tmp_file"], defaults=[None, None])
+
+
+def unit_seed(seed, vehicle, idx) -> int:
+    """
+    derives an independent seed for one work unit from the base seed,
+    so the result doesn't depend on the order or the process in which units are generated
+    :param seed: base seed of the run
+    :param vehicle: vehicle type of the unit
+    :param idx: interval index of the unit
+    :return: seed in [1, 2^31 - 1], randomTrips ignores a seed of 0
+    """
+    digest = hashlib.sha256(("%s:%s:%s" % (seed, vehicle, idx)).encode()).digest()
+    return int.from_bytes(digest[:8], "big") % (2 ** 31 - 1) + 1
+
+
+@functools.lru_cache(maxsize=None)
+def code_digest() -> tuple:
+    """
+    identifies the code the trips of a unit are generated with: the modules reading the net, the demand profile
+    and drawing the trips, and the numpy version drawing the batches
+    :return: tuple of content hashes and the numpy version
+    """
+    return (tuple(net_cache.net_digest(module.__file__) for module in (randomTrips, net_cache, demand_profile)) +
+            (randomTrips.np.__version__ if randomTrips.np is not None else None,))
+
+
+def unit_key(unit, net_digest) -> str:
+    """
+    content address of the output of a work unit, from everything the generated trips depend on
+    :param unit: WorkUnit
+    :param net_digest: content hash of the net file
+    :return: hex digest
+    """
+    key = (UNIT_CACHE_VERSION, net_digest, unit.vehicle, unit.v_class, unit.idx, unit.begin, unit.end,
+           repr(unit.period), unit.fringe, unit.seed,
+           # the demand profile is identified by its content
+           net_cache.net_digest(unit.profile) if unit.profile else None, code_digest(),
+           BATCH_SIZE if randomTrips.np is not None else None)
+    return hashlib.sha256(repr(key).encode()).hexdigest()
+
+
+def _store_unit(tmp_file, path):
+    # written under a temporary name first, so concurrent runs never read a partial file
+    tmp_path = path + ".%s.tmp" % os.getpid()
+    shutil.copyfile(tmp_file, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _write_element(file, element, indent="\t"):
+    attributes = "".join(' %s="%s"' % (key, escape(value, {'"': "&quot;"})) for key, value in element.attrib.items())
+    if len(element):
+        file.write("%s<%s%s>\n" % (indent, element.tag, attributes))
+        for child in element:
+            _write_element(file, child, indent + "\t")
+        file.write("%s</%s>\n" % (indent, element.tag))
+    else:
+        file.write("%s<%s%s/>\n" % (indent, element.tag, attributes))
+
+
+def copy_records(tmp_file, file, known_vtypes):
+    """
+    streams the records of a randomTrips output into an open trip file, holding only one record in memory.
+    vTypes equal to an already written one apart from their id are dropped and the records are switched over
+    to the written vType.
+    :param tmp_file: randomTrips output to copy from
+    :param file: trip file to append to
+    :param known_vtypes: maps the attributes of every written vType (without id) to its id, updated in place
+    :return: number of copied trips and their latest depart, None if there are none
+    """
+    trips = 0
+    max_depart = None
+    type_ids = {}
+    context = ElementTree.iterparse(tmp_file, events=("start", "end"))
+    _, root = next(context)
+    depth = 0
+    for event, element in context:
+        if event == "start":
+            depth += 1
+            continue
+        depth -= 1
+        # nested elements are written together with their top level record
+        if depth != 0:
+            continue
+
+        if element.tag == "vType":
+            key = tuple((k, v) for k, v in element.attrib.items() if k != "id")
+            if len(element):
+                key += tuple(ElementTree.tostring(child) for child in element)
+            if key not in known_vtypes:
+                known_vtypes[key] = element.get("id")
+                _write_element(file, element)
+            type_ids[element.get("id")] = known_vtypes[key]
+        else:
+            if element.get("type") in type_ids:
+                element.set("type", type_ids[element.get("type")])
+            _write_element(file, element)
+            depart = trip_meta.depart_of(element)
+            if depart is not None:
+                trips += 1
+                max_depart = depart if max_depart is None else max(max_depart, depart)
+        root.clear()
+    return trips, max_depart
+
+
+def split_records(trip_file, part_files, trips):
+    """
+    splits a time sorted trip file into consecutive parts with about the same number of trips,
+    so every part covers its own time window. Each part starts with the vTypes written before its first trip.
+    :param trip_file: trip file as written by write_trip_files
+    :param part_files: paths of the parts to write
+    :param trips: number of trips in the trip file
+    :return:
+    """
+    per_part = -(-trips // len(part_files))
+    vtypes = []
+    parts = iter(part_files)
+    file = None
+    count = 0
+    context = ElementTree.iterparse(trip_file, events=("start", "end"))
+    _, root = next(context)
+    depth = 0
+    try:
+        for event, element in context:
+            if event == "start":
+                depth += 1
+                continue
+            depth -= 1
+            if depth != 0:
+                continue
+            if file is None or (count == per_part and element.tag != "vType"):
+                if file is not None:
+                    file.write("</routes>\n")
+                    file.close()
+                file = open(next(parts), "w")
+                file.write("<routes>\n")
+                for vtype in vtypes:
+                    _write_element(file, vtype)
+                count = 0
+            _write_element(file, element)
+            if element.tag == "vType":
+                vtypes.append(element)
+            else:
+                count += 1
+                root.clear()
+        # parts left over if there were fewer trips than expected
+        for path in parts:
+            with open(path, "w") as empty:
+                empty.write("<routes>\n</routes>\n")
+    finally:
+        if file is not None:
+            file.write("</routes>\n")
+            file.close()
+
+
+def _init_worker(net_file, net_cache_dir, instrument=False):
+    global _worker_net
+    if instrument:
+        # forked workers start with a copy of the data of the parent, which reports that itself
+        instrumentation.reset()
+        instrumentation.enable()
+    with instrumentation.stage("net_load"):
+        # trip generation needs only the edge data, not the full sumolib net
+        if net_cache_dir:
+            _worker_net = net_cache.load_net(net_file, net_cache_dir)
+        else:
+            _worker_net = net_cache.read_net(net_file)
+
+
+def _run_unit(unit) -> str:
+    """
+    runs randomTrips for one work unit
+    :param unit: WorkUnit with tmp_file set
+    :return: path to the generated trips
+    """
+    args = ["-n", unit.net_file, "-o", unit.tmp_file, "-b", str(unit.begin), "-e", str(unit.end),
+            "-p", str(unit.period), "--fringe-factor", str(unit.fringe), "-s", str(unit.seed),
+            "--prefix", (unit.vehicle[:3]+"_"+str(unit.idx)+"_"), "--vehicle-class", unit.v_class]
+    if unit.profile:
+        args += ["--profile", unit.profile]
+    if randomTrips.np is not None:
+        args += ["--batch-size", str(BATCH_SIZE)]
+    if unit.net_cache_dir:
+        args += ["--generator-cache", unit.net_cache_dir]
+    randomTrips.main(randomTrips.get_options(args), _worker_net)
+    return unit.tmp_file
+
+
+def _run_unit_instrumented(unit) -> tuple:
+    """
+    runs a unit in a worker process and hands its instrumentation data over to the parent
+    :return: path to the generated trips, instrumentation data of the worker since the last unit
+    """
+    return _run_unit(unit), instrumentation.take()
+
 
 class RandomRoadRage:
 
     def __init__(self, net_file=None, output_path=None, begin=0, end=86400, fringe=5, seed=None,
-                 vehicle_types=None, amount=1000):
+                 vehicle_types=None, amount=1000, net_cache_dir=None, jobs=1, profile=DEFAULT_PROFILE,
+                 single_pass=False, routes=False, validate=False, route_shards=1, unit_cache_dir=None):
 
         self.net_file = net_file
         self.output_path = os.path.dirname(self.net_file) if not "output_path" in locals() else output_path
@@ -27,28 +252,25 @@ class RandomRoadRage:
         self.seed = randint(0, 999999) if seed is None else seed
         self.vehicle_types = vehicle_types if vehicle_types is not None else {"car": 1}
         self.amount = amount
-
-        # TODO: generalize rush hours / create designated config file and selection
-        # hardcoded K. rush hours:
-        # 0-5, 5-9, 9-17, 17-20, 20-0
-        # self.intervals = [
-        #     [0, 18000, 0.063],
-        #     [18000, 32400, 0.258],
-        #     [32400, 61200, 0.464],
-        #     [61200, 72000, 0.138],
-        #     [72000, 86400, 0.076]
-        # ]
-
-        # hardcoded D. rush hours:
-        # 0-5, 5-9, 9-17, 17-20, 20-0
-        self.intervals = [
-            [0, 3600, 0.013741390813606496],
-            [3600, 18000, 0.028648541187222026],
-            [18000, 25200, 0.0750832425185819],
-            [25200, 68400, 0.7117055790962658],
-            [68400, 75600, 0.0879492728054316],
-            [75600, 86400, 0.08287197357889226]
-        ]
+        # directory for the parsed net and edge weight caches, None parses the net file every run
+        self.net_cache_dir = net_cache_dir
+        # number of processes generating work units in parallel
+        self.jobs = jobs
+
+        # rush hours, as list of [begin, end, share of the demand] from the demand profile
+        self.profile_path = profile
+        self.profile = DemandProfile.load(self.profile_path)
+        self.intervals = self.profile.intervals
+        # generate each vehicle type in one randomTrips run over the whole profile instead of one run per interval
+        self.single_pass = single_pass
+        # route the merged trips of every vehicle type with duarouter into osm.<class>.rou.xml
+        self.routes = routes
+        # replace the trip files by the trips duarouter found a route for
+        self.validate = validate
+        # time windows every vehicle type is routed in, in parallel with up to jobs duarouter processes
+        self.route_shards = route_shards
+        # directory of the outputs of earlier work units by content hash, None generates every unit
+        self.unit_cache_dir = unit_cache_dir
 
     def main(self):
         my_parser = argparse.ArgumentParser(prog='Random Road Rage',
@@ -81,6 +303,33 @@ class RandomRoadRage:
                                help='percentage of bicycles')
         my_parser.add_argument('-a', '--amount', action='store', type=int, dest='amount', default=1000,
                                help='Generate <int> vehicles with equidistant departure times during simulation')
+        my_parser.add_argument('--net-cache', action='store', dest='net_cache_dir', default=None,
+                               help='cache the parsed net and the edge weights in this directory and reuse them '
+                                    'while the net is unchanged')
+        my_parser.add_argument('-j', '--jobs', action='store', type=int, dest='jobs', default=1,
+                               help='generate vehicle types and intervals in <int> parallel processes')
+        my_parser.add_argument('--profile', action='store', dest='profile', default=DEFAULT_PROFILE,
+                               help='demand profile file with the rush hours (Default rush_hours.profile)')
+        my_parser.add_argument('--single-pass', action='store_true', dest='single_pass', default=False,
+                               help='generate each vehicle type in one pass over the profile instead of once per '
+                                    'interval, without steps between the intervals for smooth profiles. '
+                                    'Always used for profiles given as rate curve')
+        my_parser.add_argument('--unit-cache', action='store', dest='unit_cache_dir', default=None,
+                               help='keep the output of every vehicle type and interval in this directory and reuse '
+                                    'it while the net, the profile and the parameters of the unit are unchanged')
+        my_parser.add_argument('-r', '--routes', action='store_true', dest='routes', default=False,
+                               help='route the trips of every vehicle type with one duarouter call into '
+                                    'osm.<class>.rou.xml')
+        my_parser.add_argument('--validate', action='store_true', dest='validate', default=False,
+                               help='keep only the trips duarouter finds a route for')
+        my_parser.add_argument('--route-shards', action='store', type=int, dest='route_shards', default=1,
+                               help='split the routing of every vehicle type into <int> time windows, which are '
+                                    'routed in parallel with up to --jobs processes and give the same result')
+        my_parser.add_argument('--instrument', action='store', dest='instrument', default=None,
+                               help='write the time spent in every stage and counters of the run as JSON report '
+                                    'to this file (or set RRR_INSTRUMENT)')
+        my_parser.add_argument('--cprofile', action='store', dest='cprofile', default=None,
+                               help='write a cProfile dump of the run to this file (or set RRR_CPROFILE)')
 
         args = my_parser.parse_args()
         self.net_file = args.net_file
@@ -117,76 +366,246 @@ class RandomRoadRage:
 
         self.seed = args.seed
         self.amount = args.amount
+        self.net_cache_dir = args.net_cache_dir
+        self.unit_cache_dir = args.unit_cache_dir
+        self.jobs = args.jobs
+        self.profile_path = args.profile
+        self.profile = DemandProfile.load(self.profile_path)
+        self.single_pass = args.single_pass
+        self.routes = args.routes
+        self.validate = args.validate
+        self.route_shards = args.route_shards
+        if self.route_shards < 1:
+            my_parser.error("--route-shards must be at least 1")
 
         self.begin = int(args.begin)
         self.end = int(args.end)
 
         self.adjust_intervals()
 
-        self.generate()
+        instrumentation.run("random_road_rage", args.instrument, args.cprofile, self.generate)
 
     def generate(self):
         """
         actual function to generate and write the files
+        randomTrips runs in-process, so the net is parsed only once for all vehicle types and intervals.
+        With more than one job the work units are spread over a process pool, each worker loads the net once.
+        With a unit cache only the units missing from the cache are generated, the net isn't loaded if none is.
         :return:
         """
+        units = self.work_units()
+
+        # every unit writes its own temporary file, so units and concurrent runs don't interfere
+        tmp_dir = tempfile.mkdtemp(prefix=".rrr_", dir=self.output_path or None)
+        try:
+            units = [unit._replace(tmp_file=os.path.join(tmp_dir, "%s_%s.xml" % (unit.vehicle, unit.idx)))
+                     for unit in units]
+            cache_paths = self.unit_cache_paths(units)
+            pending = [(unit, path) for unit, path in zip(units, cache_paths)
+                       if path is None or not os.path.isfile(path)]
+            if self.unit_cache_dir:
+                instrumentation.count("unit_cache_hits", len(units) - len(pending))
+                instrumentation.count("unit_cache_misses", len(pending))
+
+            with instrumentation.stage("units"):
+                generated = self.run_units([unit for unit, _ in pending])
+            for (_, path), tmp_file in zip(pending, generated):
+                if path is not None:
+                    _store_unit(tmp_file, path)
+            # cached outputs are merged straight from the cache
+            generated = {unit: tmp_file for (unit, _), tmp_file in zip(pending, generated)}
+            tmp_files = [generated.get(unit, path) for unit, path in zip(units, cache_paths)]
+
+            with instrumentation.stage("merge"):
+                files = self.write_trip_files(units, tmp_files)
+
+            if self.routes or self.validate:
+                with instrumentation.stage("routing"):
+                    self.route_trip_files(files, tmp_dir)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def run_units(self, units) -> list:
+        """
+        runs randomTrips for the work units, in a process pool with more than one job
+        :param units: WorkUnit list with tmp_file set
+        :return: output file of each unit
+        """
+        if not units:
+            return []
+        if self.jobs > 1:
+            instrument = instrumentation.enabled()
+            with ProcessPoolExecutor(max_workers=self.jobs, initializer=_init_worker,
+                                     initargs=(self.net_file, self.net_cache_dir, instrument)) as pool:
+                if not instrument:
+                    return list(pool.map(_run_unit, units))
+                tmp_files = []
+                for tmp_file, data in pool.map(_run_unit_instrumented, units):
+                    tmp_files.append(tmp_file)
+                    instrumentation.merge(data)
+                return tmp_files
+        _init_worker(self.net_file, self.net_cache_dir)
+        return [_run_unit(unit) for unit in units]
+
+    def unit_cache_paths(self, units) -> list:
+        """
+        :param units: WorkUnit list
+        :return: path of each unit in the unit cache, whether it exists or not, all None without a unit cache
+        """
+        if not self.unit_cache_dir:
+            return [None] * len(units)
+        os.makedirs(self.unit_cache_dir, exist_ok=True)
+        digest = net_cache.net_digest(self.net_file)
+        return [os.path.join(self.unit_cache_dir, unit_key(unit, digest) + ".trips.xml") for unit in units]
 
-        # first loop through vehicles, to generate a new file for each type
+    def work_units(self) -> list:
+        """
+        one unit for every vehicle type and interval which has vehicles to generate,
+        or one unit per vehicle type in single pass mode
+        :return: list of WorkUnit in output order
+        """
+        # a rate curve is split into steps of a minute, as intervals that would be a randomTrips run per minute
+        single_pass = self.single_pass or self.profile.rate_curve
+        units = []
         for vehicle in self.vehicle_types:
-            # set vehicle to passenger, if name is car, for compatibility and easier usage
-            v_class = "passenger" if vehicle == "car" else vehicle
-            # TODO: fix different id's
-            id = vehicle
-            # id = "aua_" + vehicle
-
-            routes = "<routes>\n\t<vType id=\"" + id + "\" vClass=\"" + v_class + "\"/>"
-            # generate blank xml files, closing xml tag will be written later
-            trips_file_name = "osm." + v_class + ".trips.xml"
-            file_path = os.path.join(self.output_path, trips_file_name)
-            file = open(file_path, "w+")
-            file.write(routes)
-            file.close()
-
-            # close xml tag and continue, if no vehicles were specified
+            # vehicle types without a share only get an empty trip file
             if not self.vehicle_types[vehicle]:
-                with open(file_path, "a") as file:
-                    file.write("\n</routes>")
                 continue
-
-            # open file again in append mode
-            file = open(file_path, "a")
-            file.write("\n")
+            # set vehicle to passenger, if name is car, for compatibility and easier usage
+            v_class = "passenger" if vehicle == "car" else vehicle
 
             # calculate each vehicle_amount with the current fraction
             vehicle_amount = self.amount * self.vehicle_types[vehicle]
 
+            if single_pass:
+                period = (self.end - self.begin) / vehicle_amount
+                units.append(WorkUnit(vehicle, v_class, 0, self.begin, self.end, period, self.fringe,
+                                      unit_seed(self.seed, vehicle, "profile"), self.net_file, self.net_cache_dir,
+                                      self.profile_path))
+                continue
+
             for idx, item in enumerate(self.intervals):
+                # intervals without demand, like a quiet night, have no trips to generate
+                if not item[2]:
+                    continue
                 # calculate period with ((end - start) / veh.amount ) but first multiply with rush hours
                 period = (item[1] - item[0]) / (vehicle_amount * item[2])
+                units.append(WorkUnit(vehicle, v_class, idx, item[0], item[1], period, self.fringe,
+                                      unit_seed(self.seed, vehicle, idx), self.net_file, self.net_cache_dir))
+        return units
 
-                os.system(
-                    "python randomTrips.py -n %s -o .tmp.xml -b %s -e %s -p %s --fringe-factor %s -s %s --prefix %s --vehicle-class %s" %
-                    (self.net_file, item[0], item[1], period, self.fringe, self.seed, (vehicle[:3]+"_"+str(idx)+"_"), v_class))
-
-                # After use increment seed, so cars start on different edges
-                self.seed += 1
-                tmp_xml = minidom.parse('.tmp.xml')
-
-                # TODO: ugly quick fix, make it properly
-                element_list = tmp_xml.getElementsByTagName("vType")
-                [file.write("\t" + i.toprettyxml(indent='\t', newl='\n', encoding=None)) for i in element_list]
-
-                element_list = tmp_xml.getElementsByTagName("trip")
-
-                # write trip tags to file
-                [file.write("\t" + i.toprettyxml(indent='\t', newl='\n', encoding=None)) for i in element_list]
+    def write_trip_files(self, units, tmp_files):
+        """
+        stitches the outputs of the work units together into one trip file per vehicle type,
+        and writes the number of trips and latest depart of the files to the trip_meta sidecar
+        :param units: work units as returned by work_units, in output order
+        :param tmp_files: output file of each unit
+        :return: dictionary trip file name -> (number of trips, latest depart or None)
+        """
+        meta = {}
+        # first loop through vehicles, to generate a new file for each type
+        for vehicle in self.vehicle_types:
+            # set vehicle to passenger, if name is car, for compatibility and easier usage
+            v_class = "passenger" if vehicle == "car" else vehicle
+            # TODO: fix different id's
+            id = vehicle
+            # id = "aua_" + vehicle
 
-            # close xml file with closing tag
-            file.write("\n</routes>")
-            file.close()
+            routes = "<routes>\n\t<vType id=\"" + id + "\" vClass=\"" + v_class + "\"/>"
+            trips_file_name = "osm." + v_class + ".trips.xml"
+            file_path = os.path.join(self.output_path, trips_file_name)
+            with open(file_path, "w+") as file:
+                file.write(routes)
+                if self.vehicle_types[vehicle]:
+                    file.write("\n")
+
+                # vTypes differing only in their id are merged into the first one written
+                known_vtypes = {(("vClass", v_class),): id}
+                trips = 0
+                max_depart = None
+                for unit, tmp_file in zip(units, tmp_files):
+                    if unit.vehicle == vehicle:
+                        unit_trips, unit_max_depart = copy_records(tmp_file, file, known_vtypes)
+                        trips += unit_trips
+                        if unit_max_depart is not None:
+                            max_depart = unit_max_depart if max_depart is None else max(max_depart, unit_max_depart)
+
+                # close xml file with closing tag
+                file.write("\n</routes>")
+                instrumentation.count("output_bytes", file.tell())
+            meta[trips_file_name] = (trips, max_depart)
+
+        trip_meta.write_meta(self.output_path, meta)
+        return meta
+
+    def route_trip_files(self, files, tmp_dir):
+        """
+        runs duarouter once per vehicle type on its merged trip file instead of once per work unit, so the net is
+        loaded once per type. With route_shards > 1 the trips are split into consecutive time windows routed in
+        parallel. Trips are routed independently of each other, and the routed windows are stitched together in
+        time order, so the output is the same for any number of shards.
+        :param files: dictionary trip file name -> (number of trips, latest depart or None) of write_trip_files
+        :param tmp_dir: directory for the windows and the duarouter outputs
+        :return:
+        """
+        calls = []
+        # (file to write, duarouter outputs to stitch together)
+        outputs = []
+        for vehicle in self.vehicle_types:
+            v_class = "passenger" if vehicle == "car" else vehicle
+            trips_file_name = "osm." + v_class + ".trips.xml"
+            trips = files[trips_file_name][0]
+            if not trips:
+                continue
+            trip_file = os.path.join(self.output_path, trips_file_name)
+            shards = min(self.route_shards, trips)
+            if shards > 1:
+                parts = [os.path.join(tmp_dir, "%s_window_%s.xml" % (v_class, i)) for i in range(shards)]
+                split_records(trip_file, parts, trips)
+            else:
+                parts = [trip_file]
+
+            # the same call randomTrips.py makes for -r and --validate
+            args = [randomTrips.DUAROUTER, '-n', self.net_file, '--ignore-errors', '--begin', str(self.begin),
+                    '--end', str(self.end), '--no-step-log', '--no-warnings']
+            targets = []
+            if self.routes:
+                targets.append((os.path.join(self.output_path, "osm." + v_class + ".rou.xml"), "routes", []))
+            if self.validate:
+                targets.append((trip_file, "trips", ['--write-trips']))
+            for target, kind, extra in targets:
+                routed = [os.path.join(tmp_dir, "%s_%s_%s.xml" % (v_class, kind, i)) for i in range(len(parts))]
+                calls += [args + ['-r', part, '-o', output] + extra for part, output in zip(parts, routed)]
+                outputs.append((target, routed))
+
+        instrumentation.count("duarouter_calls", len(calls))
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            for call, code in zip(calls, pool.map(subprocess.call, calls)):
+                if code != 0:
+                    print(Fore.RED + "duarouter failed on " + call[call.index('-r') + 1])
+                    sys.exit(1)
+
+        for target, routed in outputs:
+            known_vtypes = {}
+            trips = 0
+            max_depart = None
+            with open(target, "w") as file:
+                file.write("<routes>\n")
+                for output in routed:
+                    part_trips, part_max_depart = copy_records(output, file, known_vtypes)
+                    trips += part_trips
+                    if part_max_depart is not None:
+                        max_depart = part_max_depart if max_depart is None else max(max_depart, part_max_depart)
+                file.write("</routes>\n")
+            if target.endswith(".trips.xml"):
+                files[os.path.basename(target)] = (trips, max_depart)
+
+        if self.validate:
+            trip_meta.write_meta(self.output_path, files)
 
     def set_parameters(self, net_file=None, output_path=None, begin=0, end=86400, fringe=5, seed=None,
-                       vehicle_types=None, amount=1000):
+                       vehicle_types=None, amount=1000, net_cache_dir=None, jobs=1, profile=DEFAULT_PROFILE,
+                       single_pass=False, routes=False, validate=False, route_shards=1, unit_cache_dir=None):
         self.net_file = net_file
         self.output_path = output_path
         self.begin = begin
@@ -195,42 +614,32 @@ class RandomRoadRage:
         self.seed = randint(0, 999999) if seed is None else seed
         self.vehicle_types = vehicle_types if vehicle_types is not None else {"car": 1}
         self.amount = amount
+        self.net_cache_dir = net_cache_dir
+        self.jobs = jobs
+        self.profile_path = profile
+        self.profile = DemandProfile.load(self.profile_path)
+        self.intervals = self.profile.intervals
+        self.single_pass = single_pass
+        self.routes = routes
+        self.validate = validate
+        self.route_shards = route_shards
+        self.unit_cache_dir = unit_cache_dir
 
     def adjust_intervals(self) -> list:
         """
-        needed for intervals smaller than [0; 86,400]
-        :return: a new list of lists containing percentage values relative to the original hardcoded ones for one day
+        needed for intervals smaller than the profile, cuts the profile to [begin; end]
+        :return: a new list of lists containing percentage values relative to the shares of the profile
         """
-        if self.begin == 0 and self.end == 86400:
-            return self.intervals
-        if self.begin >= 86399 or self.end <= 1 or self.begin >= self.end:
+        if self.begin >= self.end:
             print("inadequate parameters, try again.")
             return []
-        new_intervals = []
-
-        # determine first to last relevant interval
-        # interval: [begin, end, percentage]
-        for interval in self.intervals:
-            # print(new_intervals)
-            if interval[0] <= self.begin < interval[1]:
-                temp = [self.begin, interval[1], interval[2]]
-                new_intervals.append(temp)
-            elif self.begin < interval[0] and interval[1] < self.end:
-                new_intervals.append(interval)
-            elif interval[0] < self.end <= interval[1]:
-                temp = [interval[0], self.end, interval[2]]
-                new_intervals.append(temp)
-                # print("breaking")
-                break
-
-        # adjusting the demand percentages of the new intervals to interval length and demand of the entire simulation
-        entire_demand = 0
-        for interval in new_intervals:
-            entire_demand = entire_demand + ((interval[1] - interval[0]) * interval[2])
-        for interval in new_intervals:
-            interval[2] = ((interval[1] - interval[0]) * interval[2]) / entire_demand
-
-        # print(entire_demand)
+        try:
+            self.intervals = self.profile.clip(self.begin, self.end).intervals
+        except ValueError:
+            print("inadequate parameters, try again.")
+            return []
+        return self.intervals
+
 
 if __name__ == "__main__":
     rrr = RandomRoadRage()
@@ -0,0 +1,140 @@
+"""
+Local cache of sensor aggregates
+
+Stores the vehicle count and mean speed per sensor and time step fetched by calibrate.py in a SQLite file,
+together with the start date of the sensor data. Later runs only fetch the time steps after the newest
+cached data from the database.
+
+"""
+
+import datetime
+import sqlite3
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class SensorCache:
+
+    def __init__(self, path, source):
+        """
+        :param path: path to the SQLite file, created if missing
+        :param source: identifies the database the aggregates come from, the cache is emptied if it changes
+        """
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);"
+            "CREATE TABLE IF NOT EXISTS aggregates (sensor_id INTEGER, step INTEGER, bucket_start TEXT, "
+            "vehicles INTEGER, speed REAL, PRIMARY KEY (sensor_id, step, bucket_start));"
+            "CREATE TABLE IF NOT EXISTS high_water (sensor_id INTEGER, step INTEGER, time TEXT, "
+            "PRIMARY KEY (sensor_id, step));")
+        if self._get_meta("source") != source:
+            self.clear()
+            self._set_meta("source", source)
+
+    def close(self):
+        self.connection.close()
+
+    def clear(self):
+        """
+        removes all cached data, so everything is fetched again
+        """
+        with self.connection:
+            self.connection.execute("DELETE FROM aggregates")
+            self.connection.execute("DELETE FROM high_water")
+            self.connection.execute("DELETE FROM meta WHERE key != 'source'")
+
+    def _get_meta(self, key):
+        row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key, value):
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def get_data_start(self):
+        """
+        :return: cached start of the sensor data as datetime, None if not cached yet
+        """
+        value = self._get_meta("data_start")
+        return datetime.datetime.strptime(value, TIME_FORMAT) if value else None
+
+    def set_data_start(self, data_start):
+        """
+        caches the start of the sensor data, the aggregates are relative to it and get dropped if it changes
+        :param data_start: datetime
+        """
+        if self.get_data_start() not in (None, data_start):
+            self.clear()
+        self._set_meta("data_start", data_start.strftime(TIME_FORMAT))
+
+    def missing(self, sensor_ids, step, start, end) -> dict:
+        """
+        finds the time ranges that have to be fetched from the database
+        :param sensor_ids: ids of the needed sensors
+        :param step: step size in seconds
+        :param start: datetime of the first needed step
+        :param end: datetime after the last needed step
+        :return: dictionary fetch start datetime -> list of sensor ids to fetch from there until end
+        """
+        missing = {}
+        for sensor_id in sorted(sensor_ids):
+            row = self.connection.execute("SELECT time FROM high_water WHERE sensor_id = ? AND step = ?",
+                                          (sensor_id, step)).fetchone()
+            fetch_start = start
+            if row:
+                high_water = datetime.datetime.strptime(row[0], TIME_FORMAT)
+                if high_water >= end:
+                    continue
+                fetch_start = max(start, high_water)
+            missing.setdefault(fetch_start, []).append(sensor_id)
+        return missing
+
+    def store(self, sensor_ids, step, start, end, aggregates):
+        """
+        replaces the cached steps of the sensors between start and end by the fetched ones.
+        The step holding the newest fetched data of a sensor may still get more data, it is fetched again next time.
+        Sensors without data in the fetched range keep their high water mark, their data may just be late.
+        :param sensor_ids: ids of the fetched sensors
+        :param step: step size in seconds
+        :param start: datetime the fetch started at
+        :param end: datetime the fetch ended at
+        :param aggregates: dictionary (sensor_id, step start datetime) -> (count, mean speed)
+        """
+        # high water mark of every sensor from its own data, sensors lag behind each other
+        newest = {}
+        for sensor_id, bucket_start in aggregates:
+            if sensor_id not in newest or bucket_start > newest[sensor_id]:
+                newest[sensor_id] = bucket_start
+        with self.connection:
+            for sensor_id in sensor_ids:
+                self.connection.execute("DELETE FROM aggregates WHERE sensor_id = ? AND step = ? "
+                                        "AND bucket_start >= ? AND bucket_start < ?",
+                                        (sensor_id, step, start.strftime(TIME_FORMAT), end.strftime(TIME_FORMAT)))
+            self.connection.executemany(
+                "INSERT INTO aggregates (sensor_id, step, bucket_start, vehicles, speed) VALUES (?, ?, ?, ?, ?)",
+                [(sensor_id, step, bucket_start.strftime(TIME_FORMAT), vehicles, speed)
+                 for (sensor_id, bucket_start), (vehicles, speed) in aggregates.items()])
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO high_water (sensor_id, step, time) VALUES (?, ?, ?)",
+                [(sensor_id, step, min(newest[sensor_id], end).strftime(TIME_FORMAT))
+                 for sensor_id in sensor_ids if sensor_id in newest])
+
+    def load(self, sensor_ids, step, start, end) -> dict:
+        """
+        :param sensor_ids: ids of the needed sensors
+        :param step: step size in seconds
+        :param start: datetime of the first needed step
+        :param end: datetime after the last needed step
+        :return: dictionary (sensor_id, step start datetime) -> (count, mean speed)
+        """
+        aggregates = {}
+        for sensor_id in sorted(sensor_ids):
+            rows = self.connection.execute(
+                "SELECT bucket_start, vehicles, speed FROM aggregates WHERE sensor_id = ? AND step = ? "
+                "AND bucket_start >= ? AND bucket_start < ?",
+                (sensor_id, step, start.strftime(TIME_FORMAT), end.strftime(TIME_FORMAT)))
+            for bucket_start, vehicles, speed in rows:
+                aggregates[(sensor_id, datetime.datetime.strptime(bucket_start, TIME_FORMAT))] = \
+                    (vehicles, float("nan") if speed is None else speed)
+        return aggregates
@@ -0,0 +1,165 @@
+"""
+Automatic matching of sensors to edges for calibrate.py
+
+Takes the coordinates of the sensors and finds the closest lane the vehicle class may use, with a grid index
+over the lane shapes built once for the net. The result is written in the id_pos_conf format of calibrate.py:
+
+edge       pos_on_edge  sensor_id
+
+Sensor coordinates either come as x and y in the coordinates of the net, or as lon and lat.
+
+"""
+
+import math
+import os
+import sys
+from collections import defaultdict
+
+import pandas as pd
+
+if 'SUMO_HOME' in os.environ:
+    sys.path.append(os.path.join(os.environ['SUMO_HOME'], 'tools'))
+import sumolib  # noqa
+
+# smallest grid cell size in meters, small search radii would spread long lanes over too many cells
+MIN_CELL_SIZE = 50.0
+
+
+class LaneIndex:
+    """
+    uniform grid over the lane shape segments of a net. With cells at least as large as the search radius,
+    all segments within the radius of a point are found in the 3x3 cells around it.
+    """
+
+    def __init__(self, net, v_class="passenger", cell_size=50.0):
+        """
+        :param net: sumolib net, read with shapes
+        :param v_class: only lanes allowing this vehicle class are indexed
+        :param cell_size: edge length of the grid cells in meters, the largest search radius
+        """
+        self.cell_size = cell_size
+        # segments as (lane, start offset on the shape, x1, y1, x2, y2)
+        self.segments = []
+        self.cells = defaultdict(list)
+        for edge in net.getEdges():
+            for lane in edge.getLanes():
+                if not lane.allows(v_class):
+                    continue
+                offset = 0.0
+                shape = lane.getShape()
+                for (x1, y1), (x2, y2) in zip(shape, shape[1:]):
+                    self._insert(len(self.segments), x1, y1, x2, y2)
+                    self.segments.append((lane, offset, x1, y1, x2, y2))
+                    offset += math.hypot(x2 - x1, y2 - y1)
+
+    def _cell(self, x, y):
+        return int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size))
+
+    def _insert(self, index, x1, y1, x2, y2):
+        # the segment is split into pieces no longer than a cell, the bounding box of each piece spans at most
+        # 2x2 cells, so a long diagonal segment is only put into the cells along it
+        pieces = max(1, int(math.ceil(math.hypot(x2 - x1, y2 - y1) / self.cell_size)))
+        cells = set()
+        for piece in range(pieces):
+            ax, ay = x1 + (x2 - x1) * piece / pieces, y1 + (y2 - y1) * piece / pieces
+            bx, by = x1 + (x2 - x1) * (piece + 1) / pieces, y1 + (y2 - y1) * (piece + 1) / pieces
+            min_i, min_j = self._cell(min(ax, bx), min(ay, by))
+            max_i, max_j = self._cell(max(ax, bx), max(ay, by))
+            cells.update((i, j) for i in range(min_i, max_i + 1) for j in range(min_j, max_j + 1))
+        for cell in cells:
+            self.cells[cell].append(index)
+
+    def nearest(self, x, y, max_distance):
+        """
+        :param x: x coordinate in the net
+        :param y: y coordinate in the net
+        :param max_distance: search radius in meters, at most the cell size
+        :return: (lane, offset along the lane shape, distance) of the closest lane, None if there is none in range
+        """
+        if max_distance > self.cell_size:
+            raise ValueError("search radius %s is larger than the cell size %s" % (max_distance, self.cell_size))
+        cell_i, cell_j = self._cell(x, y)
+        candidates = set()
+        for i in (cell_i - 1, cell_i, cell_i + 1):
+            for j in (cell_j - 1, cell_j, cell_j + 1):
+                candidates.update(self.cells.get((i, j), ()))
+
+        best = None
+        # sorted, so ties are resolved the same way every run
+        for index in sorted(candidates):
+            lane, offset, x1, y1, x2, y2 = self.segments[index]
+            dx, dy = x2 - x1, y2 - y1
+            length_sq = dx * dx + dy * dy
+            t = 0.0 if length_sq == 0 else max(0.0, min(1.0, ((x - x1) * dx + (y - y1) * dy) / length_sq))
+            distance = math.hypot(x1 + t * dx - x, y1 + t * dy - y)
+            if distance <= max_distance and (best is None or distance < best[2]):
+                best = (lane, offset + t * math.sqrt(length_sq), distance)
+        return best
+
+
+def check_locations(locations, name):
+    """
+    :param locations: pandas DataFrame with sensor coordinates
+    :param name: where the locations come from, for the error message
+    :return: locations, if they have the columns sensor_id and either x and y or lon and lat
+    """
+    if "sensor_id" not in locations or not ({"x", "y"} <= set(locations) or {"lon", "lat"} <= set(locations)):
+        raise ValueError("%s needs the columns sensor_id and either x and y or lon and lat" % name)
+    return locations
+
+
+def read_locations(path) -> pd.DataFrame:
+    """
+    reads sensor coordinates from a CSV file with a header line
+    :param path: CSV file with the columns sensor_id and either x and y or lon and lat
+    :return: pandas DataFrame with the columns of the file
+    """
+    return check_locations(pd.read_csv(path), path)
+
+
+def match(net, locations, v_class="passenger", max_distance=50.0, verbose=False) -> list:
+    """
+    matches every sensor to the closest lane allowing the vehicle class.
+    Calibrate takes one sensor per edge, of several sensors on an edge only the closest one is kept.
+    :param net: sumolib net, read with shapes
+    :param locations: pandas DataFrame with the columns sensor_id and either x and y or lon and lat
+    :param v_class: vehicle class the calibrators are for
+    :param max_distance: sensors further away from all lanes are not matched
+    :param verbose: report the sensors without a lane in range or on the same edge as another one
+    :return: list of (edge id, position on the edge, sensor id) in the order the edges were first matched
+    """
+    index = LaneIndex(net, v_class, max(max_distance, MIN_CELL_SIZE))
+    geo = "x" not in locations
+    # edge id -> (distance, position, sensor id)
+    matches = {}
+    for row in locations.itertuples(index=False):
+        x, y = net.convertLonLat2XY(row.lon, row.lat) if geo else (row.x, row.y)
+        nearest = index.nearest(x, y, max_distance)
+        if nearest is None:
+            if verbose:
+                print("No lane within %s m of sensor %s" % (max_distance, row.sensor_id))
+            continue
+        lane, offset, distance = nearest
+        # the shape may be shorter or longer than the lane, positions are relative to the lane length
+        shape_length = sumolib.geomhelper.polyLength(lane.getShape())
+        position = offset * lane.getLength() / shape_length if shape_length > 0 else 0.0
+        edge = lane.getEdge().getID()
+        if edge in matches:
+            if verbose:
+                print("Sensors %s and %s are both on edge %s, keeping the closer one" % (matches[edge][2],
+                                                                                      row.sensor_id, edge))
+            if matches[edge][0] <= distance:
+                continue
+        matches[edge] = (distance, round(position, 2), int(row.sensor_id))
+    return [(edge, position, sensor_id) for edge, (_, position, sensor_id) in matches.items()]
+
+
+def write_id_pos_conf(path, matches):
+    """
+    :param path: file to write
+    :param matches: list of (edge id, position on the edge, sensor id)
+    :return:
+    """
+    with open(path, "w") as file:
+        for edge, position, sensor_id in matches:
+            file.write("%s %s %s\n" % (edge, position, sensor_id))
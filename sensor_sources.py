@@ -0,0 +1,264 @@
+"""
+Sensor data sources for calibrate.py
+
+Every source offers the start of its data and the vehicle count and mean speed per sensor and time step.
+The sensor data consists of rows with the columns sensor_id, time and speed, like the entity table of the
+MySQL database. SQL sources let the database aggregate, CSV and Parquet sources allow offline calibration.
+
+The source is selected in config.cfg:
+
+[source]
+# mysql (default, uses the [mysql] section), sqlite, csv or parquet
+type = parquet
+path = sensor_data/
+# rows read at once, bounds the memory needed for any amount of sensor data
+chunk_size = 100000
+# table of a SQL source with the sensor coordinates, for calibrate.py --match-sensors source
+location_table = sensor
+
+"""
+
+import abc
+import datetime
+import os
+
+import pandas as pd
+from sqlalchemy import create_engine, text, bindparam, inspect
+
+COLUMNS = ["sensor_id", "time", "speed"]
+CHUNK_SIZE = 100000
+# connection pool of SQL sources, a connection for each concurrent worker
+POOL_SIZE = 5
+MAX_OVERFLOW = 10
+
+
+class SensorSource(abc.ABC):
+    """
+    base class of the sensor data sources
+    """
+
+    # identifies the source in the sensor cache
+    name = None
+    # most aggregate calls served at once, None if there is no limit
+    max_connections = None
+
+    @abc.abstractmethod
+    def data_start(self) -> datetime.datetime:
+        """
+        :return: time of the first row in the source
+        """
+
+    @abc.abstractmethod
+    def aggregate(self, sensor_ids, start, end, step) -> dict:
+        """
+        counts the rows and averages their speed per sensor and time step
+        :param sensor_ids: ids of the sensors to aggregate
+        :param start: datetime of the first step
+        :param end: datetime after the last step
+        :param step: step size in seconds
+        :return: dictionary (sensor_id, step start datetime) -> (count, mean speed)
+        """
+
+    def sensor_locations(self) -> pd.DataFrame:
+        """
+        :return: pandas DataFrame with the columns sensor_id and either x and y or lon and lat
+        """
+        raise ValueError("the %s source holds no sensor locations, give them as CSV file" % self.name)
+
+    @staticmethod
+    def _fold(df, start, step, totals):
+        """
+        adds already filtered rows to running per step counts and speed sums, one vectorized pass per chunk.
+        Like AVG in SQL, rows without speed count as vehicles but are left out of the mean speed.
+        :param df: pandas DataFrame with the columns sensor_id, time and speed
+        :param start: datetime of the first step
+        :param step: step size in seconds
+        :param totals: dictionary (sensor_id, step index) -> [count, count with speed, speed sum], updated in place
+        """
+        if df.empty:
+            return
+        buckets = (pd.to_datetime(df["time"]) - pd.Timestamp(start)) // pd.Timedelta(seconds=step)
+        grouped = df.groupby([df["sensor_id"], buckets.rename("bucket")])["speed"].agg(["size", "count", "sum"])
+        for key, count, speeds, speed_sum in zip(grouped.index, grouped["size"], grouped["count"], grouped["sum"]):
+            total = totals.setdefault((int(key[0]), int(key[1])), [0, 0, 0.0])
+            total[0] += int(count)
+            total[1] += int(speeds)
+            total[2] += float(speed_sum)
+
+    @staticmethod
+    def _means(totals, start, step) -> dict:
+        """
+        :param totals: dictionary (sensor_id, step index) -> [count, count with speed, speed sum]
+        :param start: datetime of the first step
+        :param step: step size in seconds
+        :return: dictionary (sensor_id, step start datetime) -> (count, mean speed), NaN without any speed
+        """
+        return {(sensor_id, start + datetime.timedelta(seconds=bucket * step)):
+                (count, speed_sum / speeds if speeds else float("nan"))
+                for (sensor_id, bucket), (count, speeds, speed_sum) in totals.items()}
+
+
+class SQLSource(SensorSource):
+    """
+    entity table of a SQL database, aggregated by the database itself
+    """
+
+    def __init__(self, engine, name=None, chunk_size=CHUNK_SIZE, location_table="sensor", max_connections=None):
+        """
+        :param engine: SQLAlchemy engine
+        :param name: identifies the database in the sensor cache, should not contain credentials
+        :param chunk_size: result rows fetched at once
+        :param location_table: table with the coordinates of the sensors
+        :param max_connections: size of the connection pool of the engine including its overflow, None if unlimited
+        """
+        self.engine = engine
+        self.name = name or engine.url.render_as_string(hide_password=True)
+        self.chunk_size = chunk_size
+        self.location_table = location_table
+        self.max_connections = max_connections
+
+    def data_start(self) -> datetime.datetime:
+        # read only min date for start values, pandas is not really required, but convenient
+        df = pd.read_sql('SELECT MIN(time) FROM entity', con=self.engine)
+        return pd.Timestamp(df["MIN(time)"][0]).to_pydatetime()
+
+    def sensor_locations(self) -> pd.DataFrame:
+        # the table name can't be a bound parameter, it comes from config.cfg and has to name an existing table
+        if self.location_table not in inspect(self.engine).get_table_names():
+            raise ValueError("the %s source has no table '%s' with sensor locations" % (self.name, self.location_table))
+        table = self.engine.dialect.identifier_preparer.quote(self.location_table)
+        return pd.read_sql("SELECT * FROM " + table, con=self.engine)
+
+    def _bucket_expression(self) -> str:
+        """
+        SQL expression for the index of the time step a row belongs to, counted from :start
+        """
+        if self.engine.dialect.name == "sqlite":
+            return "CAST((strftime('%s', time) - strftime('%s', :start)) / :step AS INTEGER)"
+        return "FLOOR(TIMESTAMPDIFF(SECOND, :start, time) / :step)"
+
+    def aggregate(self, sensor_ids, start, end, step) -> dict:
+        query = text("SELECT sensor_id, " + self._bucket_expression() + " AS bucket, "
+                     "COUNT(*) AS vehicles, AVG(speed) AS speed FROM entity "
+                     "WHERE sensor_id IN :sensor_ids AND time >= :start AND time < :end "
+                     "GROUP BY sensor_id, bucket").bindparams(bindparam("sensor_ids", expanding=True))
+        params = {"sensor_ids": list(sensor_ids), "step": step, "start": start, "end": end}
+
+        aggregates = {}
+        # server side cursor, the result is read in chunks instead of being held by the driver at once
+        with self.engine.connect().execution_options(stream_results=True) as connection:
+            for df in pd.read_sql(query, con=connection, params=params, chunksize=self.chunk_size):
+                for row in df.itertuples(index=False):
+                    # AVG is NULL for steps without any speed, a chunk of only those holds None instead of NaN
+                    aggregates[(int(row.sensor_id), start + datetime.timedelta(seconds=int(row.bucket) * step))] = \
+                        (int(row.vehicles), float("nan") if row.speed is None else float(row.speed))
+        return aggregates
+
+
+class CSVSource(SensorSource):
+    """
+    CSV file with a header line naming the columns sensor_id, time and speed
+    """
+
+    def __init__(self, path, chunk_size=CHUNK_SIZE):
+        """
+        :param path: path to the CSV file
+        :param chunk_size: rows read at once
+        """
+        self.path = path
+        self.name = "csv://" + os.path.abspath(path)
+        self.chunk_size = chunk_size
+
+    def _chunks(self, columns):
+        return pd.read_csv(self.path, usecols=columns, parse_dates=["time"] if "time" in columns else False,
+                           chunksize=self.chunk_size)
+
+    def data_start(self) -> datetime.datetime:
+        return pd.Timestamp(min(chunk["time"].min() for chunk in self._chunks(["time"]))).to_pydatetime()
+
+    def aggregate(self, sensor_ids, start, end, step) -> dict:
+        sensor_ids = list(sensor_ids)
+        totals = {}
+        for df in self._chunks(COLUMNS):
+            df = df[df["sensor_id"].isin(sensor_ids) & (df["time"] >= start) & (df["time"] < end)]
+            self._fold(df, start, step, totals)
+        return self._means(totals, start, step)
+
+
+class ParquetSource(SensorSource):
+    """
+    Parquet file or directory of Parquet files with the columns sensor_id, time and speed.
+    Only the needed columns and the row groups matching the sensors and time range are read.
+    """
+
+    def __init__(self, path, chunk_size=CHUNK_SIZE):
+        """
+        :param path: path to the Parquet file or directory
+        :param chunk_size: rows read at once
+        """
+        import pyarrow.dataset as ds
+
+        self.path = path
+        self.name = "parquet://" + os.path.abspath(path)
+        self.chunk_size = chunk_size
+        self.dataset = ds.dataset(path, format="parquet")
+
+    def data_start(self) -> datetime.datetime:
+        import pyarrow.compute as pc
+
+        batches = self.dataset.to_batches(columns=["time"], batch_size=self.chunk_size)
+        return pd.Timestamp(min(pc.min(batch.column(0)).as_py() for batch in batches
+                                if batch.num_rows)).to_pydatetime()
+
+    def aggregate(self, sensor_ids, start, end, step) -> dict:
+        import pyarrow.dataset as ds
+
+        condition = (ds.field("sensor_id").isin(list(sensor_ids)) &
+                     (ds.field("time") >= pd.Timestamp(start)) & (ds.field("time") < pd.Timestamp(end)))
+        totals = {}
+        for batch in self.dataset.to_batches(columns=COLUMNS, filter=condition, batch_size=self.chunk_size):
+            self._fold(batch.to_pandas(), start, step, totals)
+        return self._means(totals, start, step)
+
+
+def _pool_capacity(pool_size, max_overflow):
+    # a negative overflow lets a SQLAlchemy pool open any number of connections
+    return None if max_overflow < 0 else pool_size + max_overflow
+
+
+def from_config(config) -> SensorSource:
+    """
+    creates the source selected in the [source] section of the config, MySQL if there is none
+    :param config: configparser.ConfigParser with config.cfg read
+    :return: SensorSource
+    """
+    source_type = config.get('source', 'type', fallback='mysql')
+    chunk_size = config.getint('source', 'chunk_size', fallback=CHUNK_SIZE)
+    location_table = config.get('source', 'location_table', fallback='sensor')
+    if source_type == 'mysql':
+        mysql = config['mysql']
+        # needed for pandas read_sql
+        db_connection_str = "mysql+pymysql://" + mysql['user'] + ":" + mysql['password'] + "@" + \
+                            mysql['host'] + "/" + mysql['database']
+        # the pool has to hold a connection for every concurrent worker, stale connections are replaced
+        pool_size = mysql.getint('pool_size', POOL_SIZE)
+        max_overflow = mysql.getint('max_overflow', MAX_OVERFLOW)
+        engine = create_engine(db_connection_str,
+                               pool_size=pool_size,
+                               max_overflow=max_overflow,
+                               pool_recycle=mysql.getint('pool_recycle', 3600),
+                               pool_pre_ping=True)
+        # identifies the database in the sensor cache, without credentials
+        return SQLSource(engine, "mysql://" + mysql['host'] + "/" + mysql['database'], chunk_size,
+                         location_table, _pool_capacity(pool_size, max_overflow))
+
+    path = config['source']['path']
+    if source_type == 'sqlite':
+        engine = create_engine("sqlite:///" + path, pool_size=POOL_SIZE, max_overflow=MAX_OVERFLOW)
+        return SQLSource(engine, "sqlite://" + os.path.abspath(path), chunk_size, location_table,
+                         _pool_capacity(POOL_SIZE, MAX_OVERFLOW))
+    if source_type == 'csv':
+        return CSVSource(path, chunk_size)
+    if source_type == 'parquet':
+        return ParquetSource(path, chunk_size)
+    raise ValueError("unknown sensor data source type '%s'" % source_type)
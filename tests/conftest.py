@@ -0,0 +1,32 @@
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+# the modules live in the repository root, next to the scripts using them
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def netgenerate(tmp_path_factory):
+    """
+    generates nets with SUMO's netgenerate, skips the test if it isn't installed
+    :return: function taking the net name and the netgenerate options, returning the path to the net file
+    """
+    import randomTrips  # noqa, extends sys.path by SUMO_HOME/tools for sumolib
+    import sumolib
+
+    binary = sumolib.checkBinary("netgenerate")
+    if shutil.which(binary) is None:
+        pytest.skip("netgenerate is not installed")
+    net_dir = tmp_path_factory.mktemp("nets")
+
+    def generate(name, *args):
+        path = str(net_dir / (name + ".net.xml"))
+        if not os.path.isfile(path):
+            subprocess.check_call([binary, "--no-warnings", "-o", path] + list(args), stdout=subprocess.DEVNULL)
+        return path
+
+    return generate
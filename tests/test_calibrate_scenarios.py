@@ -0,0 +1,197 @@
+import datetime
+import os
+import threading
+from xml.etree import ElementTree
+
+import pytest
+
+from calibrate import Calibrate, Scenario
+from sensor_cache import SensorCache
+from sensor_sources import SensorSource
+
+START = datetime.datetime(2019, 11, 4)
+
+
+class FakeSource(SensorSource):
+    """
+    count and speed derived from sensor id and step, remembering the sensors of every aggregate call
+    """
+
+    name = "fake://test"
+
+    def __init__(self):
+        self.calls = []
+
+    def data_start(self):
+        return START + datetime.timedelta(hours=7)
+
+    def aggregate(self, sensor_ids, start, end, step):
+        self.calls.append(sorted(sensor_ids))
+        aggregates = {}
+        for sensor_id in sensor_ids:
+            time = start
+            while time < end:
+                index = int((time - START).total_seconds()) // step
+                # sensors without data in some steps
+                if (sensor_id + index) % 3:
+                    aggregates[(sensor_id, time)] = (sensor_id + index, 10.0 + sensor_id % 5)
+                time += datetime.timedelta(seconds=step)
+        return aggregates
+
+
+def make_scenario(tmp_path, name, edges, steps=8):
+    """
+    :param edges: list of (edge, sensor id) in the order of the id_pos_conf file
+    """
+    directory = tmp_path / name
+    directory.mkdir(parents=True)
+    sumocfg = directory / "osm.sumocfg"
+    sumocfg.write_text("<configuration>\n    <input>\n        <net-file value=\"osm.net.xml\"/>\n"
+                       "    </input>\n</configuration>\n")
+    edge_ids = [edge for edge, _ in edges]
+    return Scenario(str(sumocfg), str(directory), edge_ids, {edge: "5" for edge in edge_ids},
+                    {edge: str(sensor_id) for edge, sensor_id in edges}, steps)
+
+
+def calibrate(scenarios, chunk_size, step_size=3600):
+    calibrator = Calibrate(source=FakeSource())
+    calibrator.step_size = step_size
+    calibrator.sensor_chunk_size = chunk_size
+    calibrator.calibrate_scenarios(scenarios)
+    return calibrator.source
+
+
+# sensors shared by edges and in another order than the edges, scenarios with their edges in different orders
+EDGES = [("a", 4), ("b", 1), ("c", 4), ("d", 2), ("e", 7), ("f", 1), ("g", 3)]
+OTHER_EDGES = [("g", 3), ("x", 9), ("a", 4), ("d", 2)]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3])
+def test_chunked_output_matches_a_single_chunk(tmp_path, chunk_size):
+    single = [make_scenario(tmp_path / "single", name, edges) for name, edges in (("s1", EDGES), ("s2", OTHER_EDGES))]
+    chunked = [make_scenario(tmp_path / "chunked", name, edges) for name, edges in (("s1", EDGES), ("s2", OTHER_EDGES))]
+    calibrate(single, 100)
+    source = calibrate(chunked, chunk_size)
+    for expected, scenario in zip(single, chunked):
+        with open(os.path.join(expected.output_path, "calibrator.xml"), "rb") as file:
+            single_output = file.read()
+        with open(os.path.join(scenario.output_path, "calibrator.xml"), "rb") as file:
+            assert file.read() == single_output
+    assert max(len(call) for call in source.calls) <= chunk_size
+
+
+def test_calibrators_follow_the_edges(tmp_path):
+    scenario = make_scenario(tmp_path, "s1", EDGES)
+    calibrate([scenario], 2)
+    root = ElementTree.parse(os.path.join(scenario.output_path, "calibrator.xml")).getroot()
+    assert [element.get("edge") for element in root.iter("calibrator")] == [edge for edge, _ in EDGES]
+    assert [element.get("edge") for element in root.iter("routeProbe")] == [edge for edge, _ in EDGES]
+
+
+class PooledSource(FakeSource):
+    """
+    FakeSource with a connection pool of two connections, the first two calls wait for each other
+    """
+
+    max_connections = 2
+
+    def __init__(self):
+        super().__init__()
+        self.barrier = threading.Barrier(2, timeout=10)
+        self.lock = threading.Lock()
+        self.started = 0
+
+    def aggregate(self, sensor_ids, start, end, step):
+        with self.lock:
+            self.started += 1
+            wait = self.started <= 2
+        if wait:
+            self.barrier.wait()
+        return super().aggregate(sensor_ids, start, end, step)
+
+
+def test_workers_are_limited_to_the_connections(capsys):
+    calibrator = Calibrate(source=PooledSource())
+    calibrator.set_workers(20)
+    assert calibrator.workers == 2
+    assert "Warning" in capsys.readouterr().out
+    calibrator.set_workers(1)
+    assert calibrator.workers == 1
+    unlimited = Calibrate(source=FakeSource())
+    unlimited.set_workers(20)
+    assert unlimited.workers == 20
+
+
+def test_workers_fetch_concurrently():
+    serial = Calibrate(source=FakeSource())
+    serial.step_size = 900
+    expected = serial.fetch_aggregates([5, 3, 1, 2], START, 40)
+
+    concurrent = Calibrate(source=PooledSource())
+    concurrent.step_size = 900
+    concurrent.set_workers(2)
+    # both connections are in use at once, otherwise the barrier times out
+    assert concurrent.fetch_aggregates([5, 3, 1, 2], START, 40) == expected
+    # one query per sensor
+    assert sorted(concurrent.source.calls) == [[1], [2], [3], [5]]
+    assert serial.source.calls == [[1, 2, 3, 5]]
+
+
+@pytest.mark.parametrize("step_size", [900, 3600, 700])
+def test_flows_per_step(tmp_path, step_size):
+    scenario = make_scenario(tmp_path, "s1", [("a", 4), ("b", 2)], steps=6)
+    calibrate([scenario], 100, step_size)
+    root = ElementTree.parse(os.path.join(scenario.output_path, "calibrator.xml")).getroot()
+    for calibrator, sensor_id in zip(root.iter("calibrator"), (4, 2)):
+        flows = calibrator.findall("flow")
+        # steps without data get no flow
+        indices = [i for i in range(6) if (sensor_id + i) % 3]
+        assert [(flow.get("begin"), flow.get("end")) for flow in flows] == \
+            [(str(i * step_size), str((i + 1) * step_size)) for i in indices]
+        for flow, i in zip(flows, indices):
+            # calibrators take an hourly rate
+            assert float(flow.get("vehsPerHour")) == pytest.approx((sensor_id + i) * 3600 / step_size)
+            assert float(flow.get("speed")) == 10.0 + sensor_id % 5
+    if step_size == 900:
+        assert root.find("calibrator/flow").get("vehsPerHour") == "16"
+
+
+def test_steps_are_fetched_in_step_size_buckets():
+    calibrator = Calibrate(source=FakeSource())
+    calibrator.step_size = 900
+    aggregates = calibrator.fetch_aggregates([1], START, 8)
+    assert sorted(aggregates) == [(1, i) for i in range(8) if (1 + i) % 3]
+    assert calibrator.source.calls == [[1]]
+
+
+def test_sensor_cache_keeps_step_sizes_apart(tmp_path):
+    calibrator = Calibrate(source=FakeSource())
+    calibrator.sensor_cache = SensorCache(str(tmp_path / "cache.sqlite"), calibrator.source.name)
+    for step_size in (900, 3600, 900):
+        calibrator.step_size = step_size
+        uncached = Calibrate(source=FakeSource())
+        uncached.step_size = step_size
+        assert calibrator.fetch_aggregates([1, 2], START, 8) == uncached.fetch_aggregates([1, 2], START, 8)
+    calibrator.sensor_cache.close()
+
+
+def test_scenarios_share_the_fetch(tmp_path):
+    first = make_scenario(tmp_path, "s1", EDGES, steps=8)
+    second = make_scenario(tmp_path, "s2", OTHER_EDGES, steps=5)
+    source = calibrate([first, second], 100)
+    # every sensor of both scenarios is fetched once, for the steps of the longer scenario
+    assert source.calls == [[1, 2, 3, 4, 7, 9]]
+    for scenario, edges in ((first, EDGES), (second, OTHER_EDGES)):
+        root = ElementTree.parse(os.path.join(scenario.output_path, "calibrator.xml")).getroot()
+        assert [element.get("edge") for element in root.iter("calibrator")] == [edge for edge, _ in edges]
+        # each scenario only gets the flows of its own length
+        assert max(int(flow.get("end")) for flow in root.iter("flow")) <= scenario.steps * 3600
+
+
+def test_calibrators_are_added_to_every_sumocfg_once(tmp_path):
+    scenarios = [make_scenario(tmp_path, name, EDGES) for name in ("s1", "s2")]
+    calibrate(scenarios, 100)
+    calibrate(scenarios, 100)
+    for scenario in scenarios:
+        additional = ElementTree.parse(scenario.sumocfg).getroot().find("input/additional-files")
+        assert additional.get("value") == "calibrator.xml"
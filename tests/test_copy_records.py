@@ -0,0 +1,56 @@
+import io
+from xml.etree import ElementTree
+
+from random_road_rage import copy_records
+
+
+def write_unit(path, vtype_id, trips):
+    path.write_text('<routes>\n    <vType id="%s" vClass="truck"/>\n' % vtype_id +
+                    "".join('    <trip id="%s" type="%s" depart="%s" from="a" to="b"/>\n' % (trip, vtype_id, depart)
+                            for trip, depart in trips) +
+                    '</routes>\n')
+    return str(path)
+
+
+def test_equal_vtypes_are_written_once(tmp_path):
+    first = write_unit(tmp_path / "0.xml", "truck", [("t0", "1.00"), ("t1", "5.00")])
+    second = write_unit(tmp_path / "1.xml", "truck_1", [("t2", "12.50")])
+    file = io.StringIO()
+    file.write("<routes>\n")
+    known_vtypes = {}
+    assert copy_records(first, file, known_vtypes) == (2, 5.0)
+    assert copy_records(second, file, known_vtypes) == (1, 12.5)
+    file.write("</routes>\n")
+
+    root = ElementTree.fromstring(file.getvalue())
+    assert [vtype.get("id") for vtype in root.iter("vType")] == ["truck"]
+    # the trips of the second unit are switched over to the vType written first
+    assert [trip.get("type") for trip in root.iter("trip")] == ["truck", "truck", "truck"]
+
+
+def test_different_vtypes_are_kept(tmp_path):
+    first = write_unit(tmp_path / "0.xml", "truck", [("t0", "1.00")])
+    second = tmp_path / "1.xml"
+    second.write_text('<routes>\n    <vType id="slow" vClass="truck" maxSpeed="10"/>\n'
+                      '    <trip id="t1" type="slow" depart="2.00" from="a" to="b"/>\n</routes>\n')
+    file = io.StringIO()
+    known_vtypes = {}
+    copy_records(first, file, known_vtypes)
+    copy_records(str(second), file, known_vtypes)
+
+    root = ElementTree.fromstring("<routes>" + file.getvalue() + "</routes>")
+    assert [vtype.get("id") for vtype in root.iter("vType")] == ["truck", "slow"]
+    assert [trip.get("type") for trip in root.iter("trip")] == ["truck", "slow"]
+
+
+def test_nested_records_and_empty_units(tmp_path):
+    unit = tmp_path / "0.xml"
+    unit.write_text('<routes>\n    <person id="p0" depart="3.00">\n        <walk from="a" to="b"/>\n'
+                    '    </person>\n</routes>\n')
+    empty = tmp_path / "1.xml"
+    empty.write_text("<routes>\n</routes>\n")
+    file = io.StringIO()
+    assert copy_records(str(unit), file, {}) == (1, 3.0)
+    assert copy_records(str(empty), file, {}) == (0, None)
+    person = ElementTree.fromstring(file.getvalue())
+    assert [child.tag for child in person] == ["walk"]
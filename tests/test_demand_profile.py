@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+from demand_profile import DemandProfile
+from random_road_rage import RandomRoadRage
+
+
+def write_profile(tmp_path, text):
+    path = tmp_path / "test.profile"
+    path.write_text(text)
+    return str(path)
+
+
+def test_load_intervals_and_comments(tmp_path):
+    profile = DemandProfile.load(write_profile(tmp_path, "# begin end share\n0 3600 1  # night\n\n3600 7200 3\n"))
+    assert profile.intervals == [[0.0, 3600.0, 1.0], [3600.0, 7200.0, 3.0]]
+    assert not profile.rate_curve
+
+
+def test_load_rejects_mixed_lines(tmp_path):
+    with pytest.raises(ValueError):
+        DemandProfile.load(write_profile(tmp_path, "0 3600 1\n3600 2\n"))
+
+
+def test_overlapping_intervals_are_rejected():
+    with pytest.raises(ValueError):
+        DemandProfile([[0, 100, 1], [50, 150, 1]])
+
+
+def test_rate_curve_steps():
+    profile = DemandProfile.from_rates([[0, 0], [600, 10]], resolution=60)
+    assert profile.rate_curve
+    assert len(profile.intervals) == 10
+    # the mean rate of every step times its length
+    assert profile.intervals[0] == [0.0, 60.0, 0.5 * 60]
+    assert profile.intervals[-1] == [540.0, 600.0, 9.5 * 60]
+    # 3 * 0.1 / 0.1 is slightly more than 3
+    assert len(DemandProfile.from_rates([[0, 1], [3 * 0.1, 1]], resolution=0.1).intervals) == 3
+
+
+def test_clip_scales_the_shares():
+    profile = DemandProfile([[0, 100, 1], [100, 200, 0], [200, 400, 3]]).clip(50, 300)
+    assert profile.intervals == [[50.0, 100.0, 0.25], [100.0, 200.0, 0.0], [200.0, 300.0, 0.75]]
+    assert sum(share for _, _, share in profile.intervals) == pytest.approx(1)
+
+
+def test_clip_without_demand():
+    with pytest.raises(ValueError):
+        DemandProfile([[0, 100, 0], [100, 200, 1]]).clip(0, 100)
+
+
+def test_departures_follow_the_shares():
+    profile = DemandProfile([[0, 100, 1], [100, 200, 3]])
+    chunks = list(profile.departures(100, chunk_size=30))
+    assert [len(chunk) for chunk in chunks] == [30, 30, 30, 10]
+    times = np.concatenate(chunks)
+    assert times[0] == 0
+    assert np.all(np.diff(times) > 0)
+    assert np.count_nonzero(times < 100) == 25
+
+
+def test_poisson_departures():
+    profile = DemandProfile([[0, 100, 1], [100, 200, 3]])
+    counts = []
+    for seed in range(50):
+        chunks = list(profile.departures(400, np.random.default_rng(seed), poisson=True, chunk_size=64))
+        times = np.concatenate(chunks)
+        assert all(len(chunk) == 64 for chunk in chunks[:-1])
+        assert np.all(np.diff(times) >= 0) and times.max() < 200
+        counts.append(len(times))
+    assert np.mean(counts) == pytest.approx(400, rel=0.05)
+
+
+def test_zero_share_intervals_get_no_unit(tmp_path):
+    rrr = RandomRoadRage("unused.net.xml", amount=100, seed=1, end=10800,
+                         profile=write_profile(tmp_path, "0 3600 0\n3600 7200 1\n7200 10800 1\n"))
+    rrr.adjust_intervals()
+    units = rrr.work_units()
+    assert [unit.idx for unit in units] == [1, 2]
+    assert [unit.period for unit in units] == pytest.approx([72, 72])
+
+
+def test_rate_curves_are_generated_in_one_pass(tmp_path):
+    rrr = RandomRoadRage("unused.net.xml", amount=100, seed=1,
+                         profile=write_profile(tmp_path, "0 0\n43200 5\n86400 0\n"))
+    rrr.adjust_intervals()
+    units = rrr.work_units()
+    assert len(units) == 1
+    assert units[0].profile == rrr.profile_path
@@ -0,0 +1,33 @@
+import os
+import shutil
+
+import randomTrips
+
+
+def cached_generators(net_file, cache_dir):
+    options = randomTrips.get_options(["-n", net_file, "--generator-cache", cache_dir])
+    net = randomTrips.net_cache.read_net(net_file)
+    return randomTrips.get_edge_generators(net, options)
+
+
+def test_generators_are_keyed_by_net_content(netgenerate, tmp_path):
+    net_file = str(tmp_path / "test.net.xml")
+    shutil.copy(netgenerate("grid", "--grid", "--grid.number", "3"), net_file)
+    cache_dir = str(tmp_path / "cache")
+    cached_generators(net_file, cache_dir)
+    assert len(os.listdir(cache_dir)) == 1
+    cached_generators(net_file, cache_dir)
+    assert len(os.listdir(cache_dir)) == 1
+
+    # same size and modification time, but other edge lengths
+    stat = os.stat(net_file)
+    with open(net_file) as file:
+        content = file.read()
+    changed = content.replace('length="', 'length="1', 1)
+    changed = changed.replace('    ', '   ', 1)
+    assert len(changed) == len(content) and changed != content
+    with open(net_file, "w") as file:
+        file.write(changed)
+    os.utime(net_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    cached_generators(net_file, cache_dir)
+    assert len(os.listdir(cache_dir)) == 2
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+import randomTrips
+
+
+def departs(*args):
+    options = randomTrips.get_options(["-n", "unused.net.xml"] + list(args))
+    return list(randomTrips.get_departs(options, np.random.default_rng(1)))
+
+
+@pytest.mark.parametrize("begin, end, period", [(0, 3600, 0.37), (13.3, 500, 0.1), (0, 100, 3)])
+def test_periodic_departs_match_the_unbatched_loop(begin, end, period):
+    batches = departs("-b", str(begin), "-e", str(end), "-p", str(period), "--batch-size", "64")
+    expected = []
+    depart = float(begin)
+    while depart < end:
+        expected.append(depart)
+        depart += period
+    assert np.concatenate(batches).tolist() == expected
+    assert all(len(batch) == 64 for batch in batches[:-1])
+    assert 0 < len(batches[-1]) <= 64
+
+
+def test_binomial_batches_are_full():
+    batches = departs("-e", "5000", "-p", "2", "--binomial", "4", "--batch-size", "100")
+    times = np.concatenate(batches)
+    assert all(len(batch) == 100 for batch in batches[:-1])
+    assert np.all(np.diff(times) >= 0)
+    assert times.max() < 5000
+    # one departure every 2 seconds on average
+    assert 2000 < len(times) < 3000
+
+
+def test_profile_departs(tmp_path):
+    profile = tmp_path / "test.profile"
+    profile.write_text("0 100 1\n100 200 3\n")
+    batches = departs("-e", "200", "-p", "1", "--profile", str(profile), "--batch-size", "30")
+    times = np.concatenate(batches)
+    assert len(times) == 200
+    assert all(len(batch) == 30 for batch in batches[:-1])
+    assert np.count_nonzero(times < 100) == 50
+
+
+def test_profile_departs_without_extra_period(tmp_path):
+    # 86400 / (86400 / 61) is slightly more than 61
+    profile = tmp_path / "test.profile"
+    profile.write_text("0 43200 1\n43200 86400 1\n")
+    batches = departs("-e", "86400", "-p", repr(86400 / 61), "--profile", str(profile))
+    assert len(np.concatenate(batches)) == 61
@@ -0,0 +1,126 @@
+import json
+import pstats
+import threading
+
+import pytest
+
+import instrumentation
+
+
+@pytest.fixture
+def instrumented(monkeypatch):
+    monkeypatch.setattr(instrumentation, "_enabled", True)
+    instrumentation.reset()
+    yield
+    instrumentation.reset()
+
+
+@pytest.fixture
+def disabled(monkeypatch):
+    monkeypatch.setattr(instrumentation, "_enabled", False)
+    monkeypatch.delenv(instrumentation.REPORT_ENV, raising=False)
+    monkeypatch.delenv(instrumentation.CPROFILE_ENV, raising=False)
+    instrumentation.reset()
+    yield
+    instrumentation.reset()
+
+
+def test_nothing_is_recorded_when_disabled(disabled):
+    with instrumentation.stage("sampling"):
+        instrumentation.count("trips", 10)
+        instrumentation.maximum("db_query_seconds_max", 1.0)
+    assert instrumentation.take() == ({}, {})
+
+
+def test_stages_and_counters(instrumented):
+    for _ in range(3):
+        with instrumentation.stage("outer"):
+            with instrumentation.stage("inner"):
+                sum(range(10000))
+    instrumentation.count("trips", 5)
+    instrumentation.count("trips")
+    instrumentation.maximum("db_query_seconds_max", 2.0)
+    instrumentation.maximum("db_query_seconds_max", 1.0)
+    stages, counters = instrumentation.take()
+    assert stages["outer"][0] == 3 and stages["inner"][0] == 3
+    # nested stages are counted in both
+    assert stages["outer"][1] >= stages["inner"][1] > 0
+    assert counters == {"trips": 6, "db_query_seconds_max": 2.0}
+    # take starts over
+    assert instrumentation.take() == ({}, {})
+
+
+def test_stage_is_recorded_when_its_block_fails(instrumented):
+    with pytest.raises(ValueError):
+        with instrumentation.stage("failing"):
+            raise ValueError()
+    assert instrumentation.take()[0]["failing"][0] == 1
+
+
+def test_counters_from_several_threads(instrumented):
+    def work():
+        for _ in range(1000):
+            instrumentation.count("db_queries")
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert instrumentation.take()[1] == {"db_queries": 8000}
+
+
+def test_merge_data_of_workers(instrumented):
+    instrumentation.add_stage("sampling", 1.0, 0.5)
+    instrumentation.count("trips", 10)
+    instrumentation.maximum("db_query_seconds_max", 3.0)
+    instrumentation.merge(({"sampling": [2, 2.0, 1.5], "writing": [1, 0.5, 0.25]},
+                           {"trips": 20, "db_query_seconds_max": 1.0}))
+    stages, counters = instrumentation.take()
+    assert stages == {"sampling": [3, 3.0, 2.0], "writing": [1, 0.5, 0.25]}
+    # maxima are kept, not added up
+    assert counters == {"trips": 30, "db_query_seconds_max": 3.0}
+
+
+def test_report_rates(instrumented):
+    instrumentation.add_stage("writing", 2.0, 1.0)
+    instrumentation.count("trips", 100)
+    report = instrumentation.report("randomTrips", 4.0, 3.0)
+    assert report["entry_point"] == "randomTrips"
+    assert report["stages"] == {"writing": {"calls": 1, "wall": 2.0, "cpu": 1.0}}
+    assert report["rates"] == {"trips_per_second": 25.0}
+
+
+def test_run_writes_the_report_and_profile(disabled, tmp_path, monkeypatch):
+    report_path = tmp_path / "report.json"
+    profile_path = tmp_path / "run.prof"
+    monkeypatch.setenv(instrumentation.CPROFILE_ENV, str(profile_path))
+
+    def main(trips):
+        with instrumentation.stage("sampling"):
+            instrumentation.count("trips", trips)
+        return trips
+
+    assert instrumentation.run("test", str(report_path), None, main, 7) == 7
+    report = json.loads(report_path.read_text())
+    assert report["counters"] == {"trips": 7}
+    assert report["stages"]["sampling"]["calls"] == 1
+    assert pstats.Stats(str(profile_path)).total_calls > 0
+
+
+def test_run_writes_the_report_of_a_failing_run(disabled, tmp_path):
+    report_path = tmp_path / "report.json"
+
+    def main():
+        instrumentation.count("trips", 3)
+        raise RuntimeError()
+
+    with pytest.raises(RuntimeError):
+        instrumentation.run("test", str(report_path), None, main)
+    assert json.loads(report_path.read_text())["counters"] == {"trips": 3}
+
+
+def test_run_without_instrumentation(disabled, tmp_path):
+    assert instrumentation.run("test", None, None, lambda: 1) == 1
+    assert not instrumentation.enabled()
+    assert list(tmp_path.iterdir()) == []
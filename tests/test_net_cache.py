@@ -0,0 +1,117 @@
+import gzip
+import os
+import shutil
+
+import pytest
+
+import net_cache
+from sensor_matching import sumolib
+
+NETS = {
+    "grid": ["--grid", "--grid.number", "5", "--grid.length", "100"],
+    "spider": ["--spider", "--spider.arm-number", "6", "--spider.circle-number", "4", "--spider.omit-center"],
+    "rand_lanes": ["--rand", "--rand.iterations", "150", "--seed", "5", "-L", "3"],
+    "sidewalks": ["--grid", "--grid.number", "4", "--sidewalks.guess", "--crossings.guess"],
+    "turnarounds": ["--grid", "--grid.number", "3", "--no-turnarounds", "--remove-edges.explicit", "A0B0"],
+}
+
+
+@pytest.mark.parametrize("name", sorted(NETS))
+def test_parse_equals_extract(netgenerate, name):
+    path = netgenerate(name, *NETS[name])
+    assert net_cache.parse(path) == net_cache.extract(sumolib.net.readNet(path))
+
+
+def test_parse_gzipped_net(netgenerate, tmp_path):
+    path = netgenerate("grid", *NETS["grid"])
+    gzipped = str(tmp_path / "grid.net.xml.gz")
+    with open(path, "rb") as source, gzip.open(gzipped, "wb") as target:
+        shutil.copyfileobj(source, target)
+    assert net_cache.parse(gzipped) == net_cache.parse(path)
+
+
+def test_compact_net_behaves_like_sumolib(netgenerate):
+    path = netgenerate("rand_lanes", *NETS["rand_lanes"])
+    net = sumolib.net.readNet(path)
+    compact = net_cache.read_net(path)
+    assert compact.getBBoxDiameter() == net.getBBoxDiameter()
+    assert [edge.getID() for edge in compact.getEdges()] == [edge.getID() for edge in net.getEdges()]
+    for edge, expected in zip(compact.getEdges(), net.getEdges()):
+        assert edge.getFromNode().getCoord() == expected.getFromNode().getCoord()
+        assert edge.getToNode().getCoord() == expected.getToNode().getCoord()
+        assert edge.getLength() == expected.getLength()
+        assert edge.getSpeed() == expected.getSpeed()
+        assert edge.getLaneNumber() == expected.getLaneNumber()
+        assert edge.allows("passenger") == expected.allows("passenger")
+        assert edge.allows("pedestrian") == expected.allows("pedestrian")
+        assert edge.is_fringe(edge._incoming) == expected.is_fringe(expected._incoming)
+        assert edge.is_fringe(edge._outgoing) == expected.is_fringe(expected._outgoing)
+        assert edge.getBoundingBox() == expected.getBoundingBox()
+    # edges at the same junction share its node
+    nodes = {}
+    for edge in compact.getEdges():
+        for node in (edge.getFromNode(), edge.getToNode()):
+            assert nodes.setdefault(node.getCoord(), node) is node
+
+
+def test_load_net_uses_the_cache(netgenerate, tmp_path):
+    path = str(tmp_path / "grid.net.xml")
+    shutil.copy(netgenerate("grid", *NETS["grid"]), path)
+    cache_dir = str(tmp_path / "cache")
+    first = net_cache.load_net(path, cache_dir)
+    entries = [name for name in os.listdir(cache_dir) if name.endswith(".pickle")]
+    assert len(entries) == 1
+    second = net_cache.load_net(path, cache_dir)
+    assert [edge.getID() for edge in second.getEdges()] == [edge.getID() for edge in first.getEdges()]
+
+    # a changed net gets an entry of its own
+    shutil.copy(netgenerate("spider", *NETS["spider"]), path)
+    changed = net_cache.load_net(path, cache_dir)
+    assert len([name for name in os.listdir(cache_dir) if name.endswith(".pickle")]) == 2
+    assert len(changed.getEdges()) != len(first.getEdges())
+
+
+def test_broken_cache_file_is_replaced(netgenerate, tmp_path):
+    path = netgenerate("grid", *NETS["grid"])
+    cache_dir = str(tmp_path / "cache")
+    net_cache.load_net(path, cache_dir)
+    entry = [name for name in os.listdir(cache_dir) if name.endswith(".pickle")][0]
+    with open(os.path.join(cache_dir, entry), "wb") as file:
+        file.write(b"broken")
+    assert len(net_cache.load_net(path, cache_dir).getEdges()) == len(net_cache.read_net(path).getEdges())
+
+
+def test_parse_closes_the_net_file(netgenerate, monkeypatch):
+    path = netgenerate("grid", *NETS["grid"])
+    streams = []
+
+    original = sumolib.openz
+
+    def openz(*args, **kwargs):
+        streams.append(original(*args, **kwargs))
+        return streams[-1]
+
+    monkeypatch.setattr(sumolib, "openz", openz)
+    net_cache.parse(path)
+    assert len(streams) == 1 and streams[0].closed
+
+
+def test_load_net_notices_a_net_rewritten_in_place(netgenerate, tmp_path):
+    path = str(tmp_path / "grid.net.xml")
+    shutil.copy(netgenerate("grid", *NETS["grid"]), path)
+    cache_dir = str(tmp_path / "cache")
+    net_cache.load_net(path, cache_dir)
+
+    # same size and modification time, other edge speeds
+    stat = os.stat(path)
+    with open(path) as file:
+        content = file.read()
+    changed = content.replace('speed="13.89"', 'speed="11.11"')
+    assert len(changed) == len(content) and changed != content
+    with open(path, "w") as file:
+        file.write(changed)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    speeds = {edge.getSpeed() for edge in net_cache.load_net(path, cache_dir).getEdges()}
+    assert speeds == {11.11}
+    # one entry per net content and nothing else
+    assert len(os.listdir(cache_dir)) == 2
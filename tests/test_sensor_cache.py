@@ -0,0 +1,78 @@
+import datetime
+
+import pytest
+
+from sensor_cache import SensorCache
+
+START = datetime.datetime(2019, 11, 4)
+STEP = 3600
+
+
+def hour(i):
+    return START + datetime.timedelta(hours=i)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = SensorCache(str(tmp_path / "cache.sqlite"), "sqlite://test")
+    cache.set_data_start(START)
+    yield cache
+    cache.close()
+
+
+def test_everything_is_missing_at_first(cache):
+    assert cache.missing([2, 1], STEP, START, hour(24)) == {START: [1, 2]}
+
+
+def test_high_water_mark_per_sensor(cache):
+    # sensor 2 lags behind sensor 1, sensor 3 has no data yet
+    aggregates = {(1, hour(0)): (10, 13.0), (1, hour(5)): (4, 12.0), (2, hour(2)): (7, 11.0)}
+    cache.store([1, 2, 3], STEP, START, hour(24), aggregates)
+    assert cache.missing([1, 2, 3], STEP, START, hour(24)) == {hour(5): [1], hour(2): [2], START: [3]}
+
+
+def test_incremental_fetch_keeps_older_steps(cache):
+    cache.store([1], STEP, START, hour(24), {(1, hour(0)): (10, 13.0), (1, hour(1)): (2, 9.0)})
+    # the newest step is fetched again and may have grown
+    cache.store([1], STEP, hour(1), hour(24), {(1, hour(1)): (5, 10.0), (1, hour(2)): (1, 8.0)})
+    assert cache.load([1], STEP, START, hour(24)) == {(1, hour(0)): (10, 13.0), (1, hour(1)): (5, 10.0),
+                                                        (1, hour(2)): (1, 8.0)}
+    assert cache.missing([1], STEP, START, hour(24)) == {hour(2): [1]}
+
+
+def test_sensor_without_new_rows_keeps_its_mark(cache):
+    cache.store([1, 2], STEP, START, hour(24), {(1, hour(3)): (1, 10.0), (2, hour(3)): (1, 10.0)})
+    cache.store([1, 2], STEP, hour(3), hour(24), {(1, hour(6)): (1, 10.0)})
+    assert cache.missing([1, 2], STEP, START, hour(24)) == {hour(6): [1], hour(3): [2]}
+
+
+def test_complete_sensors_are_not_missing(cache):
+    cache.store([1], STEP, START, hour(2), {(1, hour(1)): (1, 10.0)})
+    cache.store([1], STEP, hour(1), hour(2), {(1, hour(1)): (1, 10.0)})
+    assert cache.missing([1], STEP, START, hour(1)) == {}
+
+
+def test_steps_sizes_are_kept_apart(cache):
+    cache.store([1], STEP, START, hour(24), {(1, hour(4)): (1, 10.0)})
+    assert cache.missing([1], 900, START, hour(24)) == {START: [1]}
+    assert cache.load([1], 900, START, hour(24)) == {}
+
+
+def test_new_data_start_clears_the_cache(cache):
+    cache.store([1], STEP, START, hour(24), {(1, hour(4)): (1, 10.0)})
+    cache.set_data_start(hour(24))
+    assert cache.get_data_start() == hour(24)
+    assert cache.load([1], STEP, START, hour(48)) == {}
+
+
+def test_other_source_clears_the_cache(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = SensorCache(path, "sqlite://a")
+    cache.set_data_start(START)
+    cache.store([1], STEP, START, hour(24), {(1, hour(4)): (1, 10.0)})
+    cache.close()
+
+    cache = SensorCache(path, "sqlite://b")
+    assert cache.get_data_start() is None
+    assert cache.load([1], STEP, START, hour(24)) == {}
+    cache.close()
@@ -0,0 +1,101 @@
+import math
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import sensor_matching
+from sensor_matching import LaneIndex, sumolib
+
+
+def brute_force(net, x, y, v_class, max_distance):
+    # distance to the closest lane allowing the vehicle class, checking every segment
+    best = None
+    for edge in net.getEdges():
+        for lane in edge.getLanes():
+            if not lane.allows(v_class):
+                continue
+            shape = lane.getShape()
+            for (x1, y1), (x2, y2) in zip(shape, shape[1:]):
+                dx, dy = x2 - x1, y2 - y1
+                length_sq = dx * dx + dy * dy
+                t = 0.0 if length_sq == 0 else max(0.0, min(1.0, ((x - x1) * dx + (y - y1) * dy) / length_sq))
+                distance = math.hypot(x1 + t * dx - x, y1 + t * dy - y)
+                if distance <= max_distance and (best is None or distance < best[1]):
+                    best = (lane, distance)
+    return best
+
+
+@pytest.fixture(scope="module")
+def net(netgenerate):
+    path = netgenerate("matching", "--rand", "--rand.iterations", "80", "--seed", "3", "-L", "2",
+                       "--sidewalks.guess")
+    return sumolib.net.readNet(path)
+
+
+@pytest.mark.parametrize("v_class, cell_size, max_distance", [("passenger", 50, 50), ("pedestrian", 20, 20),
+                                                              ("passenger", 5, 5), ("passenger", 50, 5)])
+def test_nearest_matches_brute_force(net, v_class, cell_size, max_distance):
+    index = LaneIndex(net, v_class, cell_size)
+    (xmin, ymin), (xmax, ymax) = net.getBBoxXY()
+    rng = np.random.default_rng(7)
+    found = 0
+    for x, y in zip(rng.uniform(xmin - 50, xmax + 50, 300), rng.uniform(ymin - 50, ymax + 50, 300)):
+        nearest = index.nearest(x, y, max_distance)
+        expected = brute_force(net, x, y, v_class, max_distance)
+        if expected is None:
+            assert nearest is None
+            continue
+        found += 1
+        lane, offset, distance = nearest
+        assert distance == pytest.approx(expected[1])
+        assert lane.allows(v_class)
+        assert 0 <= offset <= sumolib.geomhelper.polyLength(lane.getShape()) + 1e-9
+    assert found > 0
+
+
+def test_radius_larger_than_the_cells(net):
+    with pytest.raises(ValueError):
+        LaneIndex(net, "passenger", 10).nearest(0, 0, 20)
+
+
+def test_segments_fill_only_the_cells_along_them(net):
+    index = LaneIndex(net, "passenger", 5)
+    cells_of = {}
+    for cell, segments in index.cells.items():
+        for segment in segments:
+            cells_of.setdefault(segment, set()).add(cell)
+    for segment, cells in cells_of.items():
+        _, _, x1, y1, x2, y2 = index.segments[segment]
+        pieces = max(1, math.ceil(math.hypot(x2 - x1, y2 - y1) / 5))
+        assert len(cells) <= 4 * pieces
+
+
+def test_match_with_a_small_radius(net):
+    lane = [lane for edge in net.getEdges() for lane in edge.getLanes() if lane.allows("passenger")][0]
+    (x1, y1), (x2, y2) = lane.getShape()[:2]
+    locations = pd.DataFrame({"sensor_id": [1], "x": [(x1 + x2) / 2], "y": [(y1 + y2) / 2]})
+    assert [sensor_id for _, _, sensor_id in sensor_matching.match(net, locations, "passenger", 0.5)] == [1]
+
+
+def test_match_keeps_the_closest_sensor_per_edge(net):
+    edge = [edge for edge in net.getEdges() if edge.allows("passenger")][0]
+    lane = edge.getLanes()[0]
+    (x1, y1), (x2, y2) = lane.getShape()[:2]
+    x, y = (x1 + x2) / 2, (y1 + y2) / 2
+    locations = pd.DataFrame({"sensor_id": [1, 2, 3], "x": [x + 0.5, x, 1e7], "y": [y, y, 1e7]})
+    matches = sensor_matching.match(net, locations, "passenger", 50)
+    # sensor 2 lies on the lane, sensor 3 far away from the net
+    assert (edge.getID(), 2) in [(edge_id, sensor_id) for edge_id, _, sensor_id in matches]
+    assert (edge.getID(), 1) not in [(edge_id, sensor_id) for edge_id, _, sensor_id in matches]
+    assert 3 not in [sensor_id for _, _, sensor_id in matches]
+    edges = [edge_id for edge_id, _, _ in matches]
+    assert len(edges) == len(set(edges))
+    for edge_id, position, sensor_id in matches:
+        assert 0 <= position <= net.getEdge(edge_id).getLength() + 0.01
+
+
+def test_check_locations():
+    sensor_matching.check_locations(pd.DataFrame({"sensor_id": [1], "lon": [11.0], "lat": [48.0]}), "test")
+    with pytest.raises(ValueError):
+        sensor_matching.check_locations(pd.DataFrame({"sensor_id": [1], "x": [1.0]}), "test")
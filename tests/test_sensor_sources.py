@@ -0,0 +1,130 @@
+import configparser
+import datetime
+import math
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import sensor_sources
+
+START = datetime.datetime(2019, 11, 4)
+END = START + datetime.timedelta(days=1)
+
+
+@pytest.fixture(scope="module")
+def rows():
+    rng = np.random.default_rng(3)
+    count = 500
+    speeds = rng.normal(13, 2, count)
+    # rows without speed, and a sensor and step with no speed at all
+    speeds[rng.random(count) < 0.2] = np.nan
+    df = pd.DataFrame({"sensor_id": rng.integers(1, 6, count),
+                       "time": [START + datetime.timedelta(seconds=int(second))
+                                for second in rng.integers(0, 86400, count)],
+                       "speed": speeds})
+    extra = pd.DataFrame({"sensor_id": [6, 6], "time": [START + datetime.timedelta(hours=3, minutes=minute)
+                                                       for minute in (5, 40)], "speed": [np.nan, np.nan]})
+    return pd.concat([df, extra], ignore_index=True)
+
+
+@pytest.fixture(scope="module")
+def sources(rows, tmp_path_factory):
+    directory = tmp_path_factory.mktemp("sources")
+    db_path = str(directory / "entity.sqlite")
+    connection = sqlite3.connect(db_path)
+    with connection:
+        connection.execute("CREATE TABLE entity (sensor_id INTEGER, time TEXT, speed REAL)")
+        connection.executemany("INSERT INTO entity VALUES (?, ?, ?)",
+                               ((int(row.sensor_id), row.time.isoformat(" "),
+                                 None if math.isnan(row.speed) else float(row.speed))
+                                for row in rows.itertuples(index=False)))
+    connection.close()
+    csv_path = str(directory / "entity.csv")
+    rows.to_csv(csv_path, index=False)
+    sources = {"sql": sensor_sources.SQLSource(sensor_sources.create_engine("sqlite:///" + db_path), chunk_size=7),
+               "csv": sensor_sources.CSVSource(csv_path, chunk_size=37)}
+    try:
+        import pyarrow  # noqa
+    except ImportError:
+        return sources
+    parquet_path = str(directory / "entity.parquet")
+    rows.to_parquet(parquet_path, row_group_size=50)
+    sources["parquet"] = sensor_sources.ParquetSource(parquet_path, chunk_size=37)
+    return sources
+
+
+def assert_same(aggregates, expected):
+    assert aggregates.keys() == expected.keys()
+    for key, (count, speed) in expected.items():
+        assert aggregates[key][0] == count
+        if math.isnan(speed):
+            assert math.isnan(aggregates[key][1])
+        else:
+            assert aggregates[key][1] == pytest.approx(speed)
+
+
+@pytest.mark.parametrize("step", [3600, 900])
+@pytest.mark.parametrize("name", ["csv", "parquet"])
+def test_file_sources_aggregate_like_sql(sources, name, step):
+    if name not in sources:
+        pytest.skip("pyarrow is not installed")
+    expected = sources["sql"].aggregate([1, 2, 4, 6], START, END, step)
+    # the missing speeds count as vehicles, but not in the mean speed
+    assert any(math.isnan(speed) for _, speed in expected.values())
+    assert_same(sources[name].aggregate([1, 2, 4, 6], START, END, step), expected)
+
+
+def test_missing_speeds_count_as_vehicles(rows, sources):
+    aggregates = sources["csv"].aggregate([1], START, END, 86400)
+    sensor = rows[rows["sensor_id"] == 1]
+    assert aggregates[(1, START)] == (len(sensor), pytest.approx(sensor["speed"].mean()))
+    assert sensor["speed"].isna().any()
+
+
+def read_config(text):
+    config = configparser.ConfigParser()
+    config.read_string(text)
+    return config
+
+
+def test_from_config_sqlite_pool(sources):
+    db_path = sources["sql"].engine.url.database
+    source = sensor_sources.from_config(read_config("[source]\ntype = sqlite\npath = %s\nchunk_size = 11\n" % db_path))
+    assert isinstance(source, sensor_sources.SQLSource)
+    assert source.chunk_size == 11
+    assert source.max_connections == sensor_sources.POOL_SIZE + sensor_sources.MAX_OVERFLOW
+    assert source.engine.pool.size() == sensor_sources.POOL_SIZE
+
+
+@pytest.mark.parametrize("pool, max_connections", [("", 15), ("pool_size = 2\nmax_overflow = 3\n", 5),
+                                                   ("max_overflow = -1\n", None)])
+def test_from_config_mysql_pool(pool, max_connections):
+    pytest.importorskip("pymysql")
+    source = sensor_sources.from_config(read_config("[mysql]\nuser = u\npassword = secret\nhost = db\n"
+                                                    "database = traffic\n" + pool))
+    assert source.max_connections == max_connections
+    # without credentials in the name of the sensor cache
+    assert source.name == "mysql://db/traffic"
+    source.engine.dispose()
+
+
+def test_file_sources_have_no_connection_limit(sources):
+    assert sources["csv"].max_connections is None
+
+
+def test_unknown_source_type():
+    with pytest.raises(ValueError):
+        sensor_sources.from_config(read_config("[source]\ntype = excel\npath = sensors.xlsx\n"))
+
+
+def test_concurrent_aggregates_over_the_pool(sources):
+    source = sources["sql"]
+    expected = {sensor_id: source.aggregate([sensor_id], START, END, 3600) for sensor_id in range(1, 7)}
+    with ThreadPoolExecutor(max_workers=source.max_connections or 6) as pool:
+        results = dict(zip(range(1, 7), pool.map(lambda sensor_id: source.aggregate([sensor_id], START, END, 3600),
+                                                 range(1, 7))))
+    for sensor_id in expected:
+        assert_same(results[sensor_id], expected[sensor_id])
@@ -0,0 +1,81 @@
+import json
+import os
+
+import trip_meta
+
+
+def write_trips(path, departs):
+    path.write_text("<routes>\n    <vType id=\"car\"/>\n" +
+                    "".join('    <trip id="%s" depart="%s"/>\n' % (i, depart) for i, depart in enumerate(departs)) +
+                    "</routes>\n")
+
+
+def test_scan(tmp_path):
+    write_trips(tmp_path / "osm.passenger.trips.xml", ["0.00", "35.50", "12.00"])
+    assert trip_meta.scan(str(tmp_path / "osm.passenger.trips.xml")) == (3, 35.5)
+    write_trips(tmp_path / "osm.bus.trips.xml", [])
+    assert trip_meta.scan(str(tmp_path / "osm.bus.trips.xml")) == (0, None)
+
+
+def test_read_meta_of_unchanged_files(tmp_path):
+    write_trips(tmp_path / "osm.passenger.trips.xml", ["0.00", "35.50"])
+    write_trips(tmp_path / "osm.bus.trips.xml", [])
+    files = {"osm.passenger.trips.xml": (2, 35.5), "osm.bus.trips.xml": (0, None)}
+    trip_meta.write_meta(str(tmp_path), files)
+    assert trip_meta.read_meta(str(tmp_path)) == files
+
+
+def test_changed_trip_file_invalidates(tmp_path):
+    path = tmp_path / "osm.passenger.trips.xml"
+    write_trips(path, ["0.00"])
+    trip_meta.write_meta(str(tmp_path), {"osm.passenger.trips.xml": (1, 0.0)})
+    write_trips(path, ["0.00", "99.00"])
+    assert trip_meta.read_meta(str(tmp_path)) is None
+    # the trip file is scanned instead
+    assert trip_meta.simulation_length(str(tmp_path)) == 99.0
+
+
+def test_touched_trip_file_invalidates(tmp_path):
+    path = tmp_path / "osm.passenger.trips.xml"
+    write_trips(path, ["0.00"])
+    trip_meta.write_meta(str(tmp_path), {"osm.passenger.trips.xml": (1, 0.0)})
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    assert trip_meta.read_meta(str(tmp_path)) is None
+
+
+def test_added_or_removed_trip_file_invalidates(tmp_path):
+    write_trips(tmp_path / "osm.passenger.trips.xml", ["0.00"])
+    trip_meta.write_meta(str(tmp_path), {"osm.passenger.trips.xml": (1, 0.0)})
+    write_trips(tmp_path / "osm.truck.trips.xml", ["50.00"])
+    assert trip_meta.read_meta(str(tmp_path)) is None
+    assert trip_meta.simulation_length(str(tmp_path)) == 50.0
+
+    trip_meta.write_meta(str(tmp_path), {"osm.passenger.trips.xml": (1, 0.0), "osm.truck.trips.xml": (1, 50.0)})
+    os.remove(tmp_path / "osm.truck.trips.xml")
+    assert trip_meta.read_meta(str(tmp_path)) is None
+
+
+def test_other_version_or_broken_sidecar(tmp_path):
+    write_trips(tmp_path / "osm.passenger.trips.xml", ["0.00"])
+    trip_meta.write_meta(str(tmp_path), {"osm.passenger.trips.xml": (1, 0.0)})
+    meta_path = tmp_path / trip_meta.META_FILE
+    meta = json.loads(meta_path.read_text())
+    meta["version"] = trip_meta.META_VERSION + 1
+    meta_path.write_text(json.dumps(meta))
+    assert trip_meta.read_meta(str(tmp_path)) is None
+    meta_path.write_text("{")
+    assert trip_meta.read_meta(str(tmp_path)) is None
+
+
+def test_simulation_length_from_the_sidecar(tmp_path):
+    write_trips(tmp_path / "osm.passenger.trips.xml", ["0.00"])
+    # a sidecar matching the files is trusted without reading the trips
+    trip_meta.write_meta(str(tmp_path), {"osm.passenger.trips.xml": (1, 1234.0)})
+    assert trip_meta.simulation_length(str(tmp_path)) == 1234.0
+
+
+def test_simulation_length_without_trips(tmp_path):
+    assert trip_meta.simulation_length(str(tmp_path)) is None
+    write_trips(tmp_path / "osm.bus.trips.xml", [])
+    assert trip_meta.simulation_length(str(tmp_path)) is None
@@ -0,0 +1,66 @@
+import numpy as np
+
+import net_cache
+import random_road_rage
+from random_road_rage import RandomRoadRage, WorkUnit, code_digest, unit_key
+
+NET_DIGEST = "0" * 64
+
+
+def make_unit(profile, **changes):
+    unit = WorkUnit("car", "passenger", 1, 3600, 7200, 2.5, 5, 42, "osm.net.xml", None, profile)
+    return unit._replace(**changes)
+
+
+def write_profile(tmp_path, text, name="test.profile"):
+    path = tmp_path / name
+    path.write_text(text)
+    return str(path)
+
+
+def test_equal_units_have_equal_keys(tmp_path):
+    profile = write_profile(tmp_path, "0 3600 1\n3600 7200 3\n")
+    assert unit_key(make_unit(profile), NET_DIGEST) == unit_key(make_unit(profile), NET_DIGEST)
+    # neither the location of the files nor the temporary output are part of the key
+    copy = write_profile(tmp_path, "0 3600 1\n3600 7200 3\n", "copy.profile")
+    assert unit_key(make_unit(profile), NET_DIGEST) == unit_key(
+        make_unit(copy, net_file="other.net.xml", net_cache_dir="cache", tmp_file="unit.xml"), NET_DIGEST)
+
+
+def test_key_changes_with_the_inputs(tmp_path):
+    profile = write_profile(tmp_path, "0 3600 1\n3600 7200 3\n")
+    key = unit_key(make_unit(profile), NET_DIGEST)
+    changes = [dict(period=2.0), dict(seed=43), dict(idx=2), dict(begin=0), dict(end=3600), dict(fringe=10),
+               dict(vehicle="truck", v_class="truck")]
+    keys = {unit_key(make_unit(profile, **change), NET_DIGEST) for change in changes}
+    keys.add(unit_key(make_unit(profile), "1" * 64))
+    keys.add(unit_key(make_unit(None), NET_DIGEST))
+    assert key not in keys
+    assert len(keys) == len(changes) + 2
+
+
+def test_key_changes_with_the_profile_content(tmp_path):
+    profile = write_profile(tmp_path, "0 3600 1\n3600 7200 3\n")
+    key = unit_key(make_unit(profile), NET_DIGEST)
+    write_profile(tmp_path, "0 3600 1\n3600 7200 4\n")
+    assert unit_key(make_unit(profile), NET_DIGEST) != key
+
+
+def test_code_digest_covers_modules_and_numpy():
+    digest = code_digest()
+    for module in (random_road_rage.randomTrips, net_cache, random_road_rage.demand_profile):
+        assert net_cache.net_digest(module.__file__) in digest
+    assert np.__version__ in digest
+
+
+def test_unit_cache_paths(netgenerate, tmp_path):
+    net_file = netgenerate("grid", "--grid", "--grid.number", "3")
+    units = [make_unit(None, idx=idx) for idx in range(3)]
+    assert RandomRoadRage(net_file).unit_cache_paths(units) == [None] * 3
+
+    cache_dir = tmp_path / "units"
+    paths = RandomRoadRage(net_file, unit_cache_dir=str(cache_dir)).unit_cache_paths(units)
+    digest = net_cache.net_digest(net_file)
+    assert paths == [str(cache_dir / (unit_key(unit, digest) + ".trips.xml")) for unit in units]
+    # the cache is content addressed, nothing but the unit files is kept in it
+    assert cache_dir.is_dir() and not list(cache_dir.iterdir())
@@ -0,0 +1,119 @@
+"""
+Metadata of the trip files written by random_road_rage.py
+
+random_road_rage.py writes osm.trips.meta.json next to its osm.<class>.trips.xml files, holding the number
+of trips and the latest depart of every file. calibrate.py takes the simulation length from there without
+reading the trips, and falls back to streaming through the trip files if the sidecar is missing or a trip
+file changed after it was written.
+
+"""
+
+import glob
+import json
+import os
+from xml.etree import ElementTree
+
+META_FILE = "osm.trips.meta.json"
+META_VERSION = 1
+TRIP_FILE_PATTERN = "osm.*.trips.xml"
+
+
+def depart_of(element):
+    """
+    :param element: top level element of a trip file
+    :return: depart time in seconds, None for elements without a numeric depart
+    """
+    try:
+        return float(element.get("depart"))
+    except (TypeError, ValueError):
+        return None
+
+
+def _file_state(path) -> dict:
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def write_meta(output_path, files):
+    """
+    writes the sidecar for freshly written trip files
+    :param output_path: directory of the trip files
+    :param files: dictionary trip file name -> (number of trips, latest depart or None)
+    :return:
+    """
+    meta = {"version": META_VERSION, "files": {}}
+    for name, (trips, max_depart) in files.items():
+        meta["files"][name] = dict(trips=trips, max_depart=max_depart, **_file_state(os.path.join(output_path, name)))
+    with open(os.path.join(output_path, META_FILE), "w") as file:
+        json.dump(meta, file, indent=1, sort_keys=True)
+
+
+def read_meta(output_path):
+    """
+    :param output_path: directory of the trip files
+    :return: dictionary trip file name -> (number of trips, latest depart or None),
+             None if there is no sidecar or it doesn't match the trip files anymore
+    """
+    try:
+        with open(os.path.join(output_path, META_FILE)) as file:
+            meta = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if meta.get("version") != META_VERSION:
+        return None
+
+    names = set(os.path.basename(path) for path in glob.glob(os.path.join(output_path, TRIP_FILE_PATTERN)))
+    if names != set(meta["files"]):
+        return None
+    files = {}
+    for name, entry in meta["files"].items():
+        if _file_state(os.path.join(output_path, name)) != {"size": entry["size"], "mtime_ns": entry["mtime_ns"]}:
+            return None
+        files[name] = (entry["trips"], entry["max_depart"])
+    return files
+
+
+def scan(path):
+    """
+    streams through a trip file, holding only one trip in memory
+    :param path: path to the trip file
+    :return: (number of trips, latest depart or None)
+    """
+    trips = 0
+    max_depart = None
+    context = ElementTree.iterparse(path, events=("start", "end"))
+    _, root = next(context)
+    depth = 0
+    for event, element in context:
+        if event == "start":
+            depth += 1
+            # attributes are complete at the start event already
+            if depth == 1:
+                depart = depart_of(element)
+                if depart is not None:
+                    trips += 1
+                    max_depart = depart if max_depart is None else max(max_depart, depart)
+            continue
+        depth -= 1
+        if depth == 0:
+            root.clear()
+    return trips, max_depart
+
+
+def simulation_length(output_path, verbose=False):
+    """
+    latest depart over all trip files of a directory, from the sidecar if it is up to date
+    :param output_path: directory of the trip files
+    :param verbose: tell where the value comes from
+    :return: latest depart in seconds, None if there are no trips
+    """
+    files = read_meta(output_path)
+    if files is None:
+        if verbose:
+            print("Scanning trip files for the simulation length")
+        files = {os.path.basename(path): scan(path)
+                 for path in sorted(glob.glob(os.path.join(output_path, TRIP_FILE_PATTERN)))}
+    elif verbose:
+        print("Simulation length read from", META_FILE)
+    departs = [max_depart for _, max_depart in files.values() if max_depart is not None]
+    return max(departs) if departs else None